@@ -11,23 +11,149 @@ from scipy.stats import norm
 def B(t, T, a):
     return 1/a*(1 - np.exp(-a*(T - t)))
  
-def ZBP(P_T0, P_T1, T0, T1, K, a, sigma):
-    # B is in lecture 5 page 26
-    sigma_p = sigma*np.sqrt((1-np.exp(-2*a*T0))/(2*a))*B(T0, T1, a)
+def _factor_moments(T0, a, sigma, sigma_times):
+    # variance v and mean shift g of the zero mean factor x at T0 for a
+    # piecewise constant sigma, sigma[k] up to sigma_times[k] and the last
+    # piece extended flat. On a piece (s, e) v adds sigma^2*exp(-2a(T0-e))*
+    # B2(e-s) and g adds sigma^2/2*(B(s,T0)^2 - B(e,T0)^2)
+    T0 = np.asarray(T0, dtype=float)[..., None]
+    sigma = np.asarray(sigma, dtype=float)
+    knots = np.append(0, sigma_times)[:len(sigma)]
+    starts = np.minimum(knots, T0)
+    ends = np.minimum(np.append(knots[1:], np.inf), T0)
+    b = lambda k, h: -np.expm1(-k*h)/k
+    v = (sigma**2*np.exp(-2*a*(T0 - ends))*b(2*a, ends - starts)).sum(axis=-1)
+    g = 0.5*(sigma**2*(b(a, T0 - starts)**2 - b(a, T0 - ends)**2)).sum(axis=-1)
+    return v, g
+
+def ZBP(P_T0, P_T1, T0, T1, K, a, sigma, sigma_times=None):
+    # B is in lecture 5 page 26, with sigma_times sigma is piecewise constant
+    # (see _factor_moments)
+    if sigma_times is None:
+        sigma_p = sigma*np.sqrt((1-np.exp(-2*a*T0))/(2*a))*B(T0, T1, a)
+    else:
+        sigma_p = np.sqrt(_factor_moments(T0, a, sigma, sigma_times)[0])*B(T0, T1, a)
  
     d1 = np.log(P_T1/(K*P_T0))/sigma_p + (sigma_p/2)
     d2 = d1 - sigma_p
     return K*P_T0*norm.cdf(-d2)-P_T1*norm.cdf(-d1)
+
+def _dlog_h(u):
+    # (exp(-u) - (1 - exp(-u))/u)/u, the derivative of (1 - exp(-u))/u, with
+    # its Taylor series for small u where the terms cancel
+    u = np.asarray(u, dtype=float)
+    n = np.arange(1, 10)
+    series = np.dot(u[..., None]**(n - 1), (-1.0)**n*n/np.cumprod(np.arange(1, 11))[1:])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        exact = (np.exp(-u) + np.expm1(-u)/u)/u
+    return np.where(u < 0.1, series, exact)
+
+def ZBP_grad(P_T0, P_T1, T0, T1, K, a, sigma):
+    # derivatives of ZBP with respect to a and sigma for a fixed strike, both
+    # through sigma_p (the vega of the put is P_T1*pdf(d1)), stacked on the
+    # first axis
+    tau = T1 - T0
+    v = T0*(-np.expm1(-2*a*T0))/(2*a*T0)
+    b = B(T0, T1, a)
+    sigma_p = sigma*np.sqrt(v)*b
+    d1 = np.log(P_T1/(K*P_T0))/sigma_p + (sigma_p/2)
+    vega = P_T1*norm.pdf(d1)
+    dv_da = 2*T0**2*_dlog_h(2*a*T0)
+    db_da = tau**2*_dlog_h(a*tau)
+    dsigma_p_da = sigma*(0.5*dv_da/np.sqrt(v)*b + np.sqrt(v)*db_da)
+    return np.stack((vega*dsigma_p_da, vega*sigma_p/sigma))
+
+def ZBC(P_T0, P_T1, T0, T1, K, a, sigma, sigma_times=None):
+    # put-call parity of the zero bond options
+    return ZBP(P_T0, P_T1, T0, T1, K, a, sigma, sigma_times) + P_T1 - K*P_T0
  
-def hw_caplet(T0, T1, N, K, P_T0, P_T1, a, sigma):
+def hw_caplet(T0, T1, N, K, P_T0, P_T1, a, sigma, sigma_times=None):
     tau = T1-T0
-    return N*(1+K*tau)*ZBP(P_T0, P_T1, T0, T1, 1/(1+K*tau), a, sigma)
+    return N*(1+K*tau)*ZBP(P_T0, P_T1, T0, T1, 1/(1+K*tau), a, sigma, sigma_times)
  
  
-def hw_cap(T0, T1, N, K, P_T0, P_T1, a, sigma):
+def hw_cap(T0, T1, N, K, P_T0, P_T1, a, sigma, sigma_times=None):
     caplet = np.zeros(len(T0))
     for i in range(len(T0)):
-        caplet[i] = hw_caplet(T0[i], T1[i], N, K, P_T0[i], P_T1[i], a, sigma)
+        caplet[i] = hw_caplet(T0[i], T1[i], N, K, P_T0[i], P_T1[i], a, sigma, sigma_times)
     return sum(caplet)
 
 
+def zcb_interp(T, zcb_maturities, zcb_prices):
+    # log-linear interpolation of the ZCB prices, the curve is not
+    # extrapolated after its last maturity
+    zcb_maturities = np.asarray(zcb_maturities, dtype=float)
+    if np.max(T) > zcb_maturities[-1] + 1e-8:
+        raise ValueError('maturity {:g} is after the last maturity of the curve {:g}'
+                         .format(np.max(T), zcb_maturities[-1]))
+    return np.exp(np.interp(T, zcb_maturities, np.log(zcb_prices)))
+
+
+def hw_swaptions(expiries, tenors, strikes, zcb_maturities, zcb_prices, a, sigma, N=1,
+                 frequency=1, payer=True, tol=1e-14, max_iter=50, grad=False, sigma_times=None):
+    # Jamshidian decomposition of European swaptions, the expiries, tenors,
+    # strikes and payer flags are broadcast together. If grad is True the
+    # derivatives with respect to a and sigma are returned too (only for a
+    # constant sigma)
+    if grad and sigma_times is not None:
+        raise ValueError('the gradient needs a constant sigma')
+    T0, tenors, K, payer = np.broadcast_arrays(np.asarray(expiries, dtype=float),
+                                               np.asarray(tenors, dtype=float),
+                                               np.asarray(strikes, dtype=float),
+                                               np.asarray(payer, dtype=bool))
+    T0, tenors, K, payer = T0[..., None], tenors[..., None], K[..., None], payer[..., None]
+    tau = 1.0/frequency
+
+    # fixed leg payment times up to the longest tenor, the coupons after the
+    # end of a tenor are zero
+    n = np.round(tenors*frequency).astype(int)
+    i = np.arange(1, n.max() + 1)
+    Ti = T0 + tau*i
+    c = np.where(i <= n, K*tau, 0.0) + (i == n)
+
+    P_T0 = zcb_interp(T0, zcb_maturities, zcb_prices)
+    # the payment times after the end of a tenor are not priced
+    P_Ti = zcb_interp(np.where(c != 0, Ti, T0), zcb_maturities, zcb_prices)
+
+    # P(T0, Ti) = A_i*exp(-B_i*x) with x the zero mean factor of the short rate
+    B_i = B(T0, Ti, a)
+    if sigma_times is None:
+        v = sigma**2*(1 - np.exp(-2*a*T0))/(2*a)
+        g = sigma**2/(2*a**2)*(1 - np.exp(-a*T0))**2
+    else:
+        v, g = _factor_moments(T0, a, sigma, sigma_times)
+    A_i = P_Ti/P_T0*np.exp(-B_i*g - 0.5*B_i**2*v)
+
+    # critical x where the coupon bond is worth 1, the log of the bond price
+    # is convex and decreasing in x so Newton converges from x = 0
+    x = np.zeros(T0.shape)
+    for _ in range(max_iter):
+        bond = c*A_i*np.exp(-B_i*x)
+        total = bond.sum(axis=-1, keepdims=True)
+        step = np.log(total)*total/(B_i*bond).sum(axis=-1, keepdims=True)
+        x = x + step
+        if np.max(np.abs(step)) < tol:
+            break
+
+    K_i = A_i*np.exp(-B_i*x)
+    options = np.where(payer, ZBP(P_T0, P_Ti, T0, Ti, K_i, a, sigma, sigma_times),
+                       ZBC(P_T0, P_Ti, T0, Ti, K_i, a, sigma, sigma_times))
+    if not grad:
+        return N*(c*options).sum(axis=-1)
+
+    # the strikes K_i sum to 1 with the coupons and the put and call deltas
+    # to the strike are the same for all i, so only sigma_p moves the price
+    # (the call and the put have the same vega)
+    gradient = N*(c*ZBP_grad(P_T0, P_Ti, T0, Ti, K_i, a, sigma)).sum(axis=-1)
+    return N*(c*options).sum(axis=-1), gradient
+
+
+def hw_swaption(expiries, tenors, strikes, zcb_maturities, zcb_prices, a, sigma, N=1,
+                frequency=1, payer=True, tol=1e-14, max_iter=50, sigma_times=None):
+    # European swaptions over a grid of expiries, tenors and strikes, the
+    # output has shape (expiries, tenors, strikes)
+    expiries = np.asarray(expiries, dtype=float)[:, None, None]
+    tenors = np.asarray(tenors, dtype=float)[None, :, None]
+    strikes = np.asarray(strikes, dtype=float)[None, None, :]
+    return hw_swaptions(expiries, tenors, strikes, zcb_maturities, zcb_prices, a, sigma, N,
+                        frequency, payer, tol, max_iter, sigma_times=sigma_times)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration of HWModel over a history of dates with warm starts
+"""
+
+import csv
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+import numpy as np
+from hw_calibration import HWModel
+
+FIELDS = ['Date', 'a', 'sigma', 'Error', 'Success', 'Status', 'Iterations', 'Evaluations',
+          'Warm start', 'Time', 'Message']
+
+
+def _calibrate_date(date, cap_data, caplet_data, initial, notional):
+    """
+    Helper function that calibrates HWModel on one date and returns the row of
+    the output
+    """
+    start = time.perf_counter()
+    model = HWModel(cap_data, caplet_data)
+    result = model.calibration(initial, notional, display=False)
+    return {'Date': date,
+            'a': result.x[0],
+            'sigma': result.x[1],
+            'Error': result.fun,
+            'Success': bool(result.success),
+            'Status': result.status,
+            'Iterations': result.nit,
+            'Evaluations': result.nfev,
+            'Time': time.perf_counter() - start,
+            'Message': result.message}
+
+
+def _chunk_rows(chunk, seed, initial, notional):
+    """
+    Helper function that calibrates a chunk of consecutive dates and yields
+    the row of every date as soon as it is done. Every date starts from the
+    solution of the previous date, the first one from the solution of the
+    seed date (the date before the chunk, calibrated from the initial
+    parameters) if there is one. If a warm start does not converge the date
+    is calibrated again from the initial parameters
+    """
+    guess = initial
+    if seed is not None:
+        result = HWModel(*seed).calibration(initial, notional, display=False)
+        if result.success:
+            guess = list(result.x)
+    for date, cap_data, caplet_data in chunk:
+        row = _calibrate_date(date, cap_data, caplet_data, guess, notional)
+        row['Warm start'] = guess is not initial
+        if row['Warm start'] and not row['Success']:
+            cold = _calibrate_date(date, cap_data, caplet_data, initial, notional)
+            cold['Warm start'] = False
+            if cold['Success'] or cold['Error'] < row['Error']:
+                row = cold
+        yield row
+        guess = [row['a'], row['sigma']] if row['Success'] else initial
+
+
+def _calibrate_chunk(chunk, seed, initial, notional, rows_queue):
+    """
+    Helper function that calibrates a chunk of dates in a worker process, the
+    rows are put in the queue as soon as their dates are done and returned in
+    order of the dates
+    """
+    rows = []
+    for row in _chunk_rows(chunk, seed, initial, notional):
+        rows_queue.put(row)
+        rows.append(row)
+    return rows
+
+
+def batch_calibration(panel, output, initial=(0.001, 0.05), notional=1.0, chunk_size=20,
+                      processes=None):
+    """
+    This function calibrates a and sigma on every date of a history of cap
+    data. The dates are split in chunks of consecutive dates, the dates of
+    every chunk are calibrated in order starting from the solution of the
+    previous date, and the chunks can be calibrated by several processes.
+    The first date of a chunk starts from the solution of the date before
+    the chunk, which the chunk calibrates once more from initial, so a
+    chunk costs one extra calibration but no date loses its warm start
+
+    Parameters
+    ----------
+        panel : dictionary that maps the dates to (cap_data, caplet_data)
+            pairs, see HWModel, the dates are sorted
+        output : path of the output csv file, one row per date is written as
+            soon as the date is calibrated, with several processes the rows
+            of different chunks are written in the order they are done
+        initial : initial a and sigma of the first date and of the dates
+            before the chunks, default value is (0.001, 0.05)
+        notional : notional of the caps, default value is 1
+        chunk_size : number of dates of every chunk, default value is 20
+        processes : number of processes the chunks are distributed over, by
+            default they are calibrated in this process
+
+    Return
+    ------
+        out: ndarray of shape (D, 2) with a and sigma of every date
+
+    """
+    initial = list(initial)
+    dates = sorted(panel)
+    starts = range(0, len(dates), chunk_size)
+    chunks = [[(date, ) + tuple(panel[date]) for date in dates[start:start + chunk_size]]
+              for start in starts]
+    seeds = [tuple(panel[dates[start - 1]]) if start > 0 else None for start in starts]
+
+    with open(output, 'w', newline='') as stream:
+        writer = csv.DictWriter(stream, fieldnames=FIELDS)
+        writer.writeheader()
+
+        def write(row):
+            writer.writerow(row)
+            stream.flush()
+
+        if processes is None:
+            rows = []
+            for chunk, seed in zip(chunks, seeds):
+                for row in _chunk_rows(chunk, seed, initial, notional):
+                    write(row)
+                    rows.append(row)
+        else:
+            with Manager() as manager, ProcessPoolExecutor(processes) as executor:
+                rows_queue = manager.Queue()
+                futures = [executor.submit(_calibrate_chunk, chunk, seed, initial, notional, rows_queue)
+                           for chunk, seed in zip(chunks, seeds)]
+                written = 0
+                while written < len(dates):
+                    try:
+                        write(rows_queue.get(timeout=0.1))
+                        written += 1
+                    except queue.Empty:
+                        # a failed chunk would never put its rows
+                        for future in futures:
+                            if future.done() and future.exception() is not None:
+                                raise future.exception()
+                # the chunks come back in order of the dates
+                rows = [row for future in futures for row in future.result()]
+    return np.array([(row['a'], row['sigma']) for row in rows]).reshape(-1, 2)
@@ -5,60 +5,282 @@ Created on Mon Nov 13 09:58:11 2017
 @author: Jesus
 """
 
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from scipy.optimize import minimize
-from hull_white_formulas import hw_cap
+from scipy.optimize import brentq, minimize
+from hull_white_formulas import ZBP, ZBP_grad, hw_swaptions
 
 
 class HWModel(object):
-    def __init__(self, cap_data, caplet_data):
+    def __init__(self, cap_data=None, caplet_data=None, swaption_data=None, zcb_data=None,
+                 frequency=1):
         # cap data
-        self._black_prices = cap_data['Cap']
-        self._strikes = cap_data['Strike']
+        self._black_prices = None
+        self._cap_maturities = None
+        self._strikes = None
+        if cap_data is not None:
+            self._black_prices = cap_data['Cap']
+            self._cap_maturities = cap_data['Maturity']
+            self._strikes = cap_data['Strike']
         # caplet data
-        self._resets = caplet_data['Reset']
-        self._maturities = caplet_data['Maturity']
-        self._discounts_reset = caplet_data['ZCB at reset']
-        self._discounts_maturity = caplet_data['ZCB at maturity']
-        # calibrated parameters
+        self._resets = None
+        self._maturities = None
+        self._discounts_reset = None
+        self._discounts_maturity = None
+        if caplet_data is not None:
+            self._resets = caplet_data['Reset']
+            self._maturities = caplet_data['Maturity']
+            self._discounts_reset = caplet_data['ZCB at reset']
+            self._discounts_maturity = caplet_data['ZCB at maturity']
+        # swaption data, one row per swaption with the market price and
+        # optionally whether it is a payer swaption (default)
+        self._swaptions = swaption_data
+        self._frequency = frequency
+        # discount curve of the swaptions, by default the ZCB prices of the
+        # caplet data
+        if swaption_data is not None and zcb_data is None and caplet_data is None:
+            raise ValueError('the swaptions need a discount curve, zcb_data or caplet_data')
+        if zcb_data is not None:
+            self._zcb_maturities = np.asarray(zcb_data['Maturity'], dtype=float)
+            self._zcb_prices = np.asarray(zcb_data['ZCB'], dtype=float)
+        elif caplet_data is not None:
+            curve = dict(zip(np.append(self._resets, self._maturities),
+                             np.append(self._discounts_reset, self._discounts_maturity)))
+            curve.setdefault(0.0, 1.0)
+            self._zcb_maturities = np.array(sorted(curve))
+            self._zcb_prices = np.array([curve[T] for T in self._zcb_maturities])
+        # the caplets of every cap are the ones that mature up to the cap
+        # maturity, so every cap is a partial sum of the caplets of its strike
+        if cap_data is not None and caplet_data is not None:
+            maturities = np.asarray(self._maturities, dtype=float)
+            cap_maturities = np.asarray(self._cap_maturities, dtype=float)
+            self._caplet_counts = np.sum(maturities <= cap_maturities[:, None] + 1.e-8, axis=1)
+            self._unique_strikes, self._strike_index = np.unique(np.asarray(self._strikes, dtype=float),
+                                                                 return_inverse=True)
+        # calibrated parameters, sigma is piecewise constant if sigma_times is
+        # set (see bootstrap)
         self._a = None
         self._sigma = None
-        
-    def calibration(self, initial, notional=1.0, method='SLSQP', display=False):
+        self._sigma_times = None
+
+    def cap_errors(self, param, notional=1.0, jac=False):
+        """
+        Returns the relative errors of the Hull-White cap prices, every caplet
+        is priced once per strike and the caps are the cumulative sums of the
+        caplets. If jac is True it also returns the jacobian of the errors
+        with respect to a and sigma, an ndarray of shape (C, 2). a and sigma
+        can be arrays of shape (G, 1, 1), then the errors have shape (G, C)
+        """
+        if self._black_prices is None:
+            return (np.zeros(0), np.zeros((0, 2))) if jac else np.zeros(0)
+        T0 = np.asarray(self._resets, dtype=float)
+        T1 = np.asarray(self._maturities, dtype=float)
+        P_T0 = np.asarray(self._discounts_reset, dtype=float)
+        P_T1 = np.asarray(self._discounts_maturity, dtype=float)
+        # one row of caplets for every distinct strike
+        K = self._unique_strikes[:, None]
+        factor = notional*(1 + K*(T1 - T0))
+        strikes = 1/(1 + K*(T1 - T0))
+        caps = (self._strike_index, self._caplet_counts - 1)
+        black_prices = np.asarray(self._black_prices, dtype=float)
+
+        caplets = factor*ZBP(P_T0, P_T1, T0, T1, strikes, param[0], param[1])
+        hw_prices = np.cumsum(caplets, axis=-1)[(Ellipsis, ) + caps]
+        errors = (black_prices - hw_prices)/black_prices
+        if not jac:
+            return errors
+        caplet_grad = factor*ZBP_grad(P_T0, P_T1, T0, T1, strikes, param[0], param[1])
+        hw_grad = np.cumsum(caplet_grad, axis=-1)[(Ellipsis, ) + caps]
+        return errors, -(hw_grad/black_prices).T
+
+    def swaption_errors(self, param, notional=1.0, jac=False):
+        """
+        Returns the relative errors of the Hull-White swaption prices, all the
+        swaptions are priced in one batched call. If jac is True it also
+        returns the jacobian of the errors with respect to a and sigma, an
+        ndarray of shape (S, 2). a and sigma can be arrays of shape (G, 1, 1),
+        then the errors have shape (G, S)
+        """
+        if self._swaptions is None:
+            return (np.zeros(0), np.zeros((0, 2))) if jac else np.zeros(0)
+        swaptions = self._swaptions
+        payer = swaptions['Payer'] if 'Payer' in swaptions else True
+        result = hw_swaptions(swaptions['Expiry'], swaptions['Tenor'], swaptions['Strike'],
+                              self._zcb_maturities, self._zcb_prices, param[0], param[1],
+                              notional, self._frequency, payer, grad=jac)
+        market_prices = np.asarray(swaptions['Swaption'], dtype=float)
+        if not jac:
+            return (market_prices - result)/market_prices
+        hw_prices, hw_grad = result
+        return (market_prices - hw_prices)/market_prices, -(hw_grad/market_prices).T
+
+    def _grid_objective(self, points, notional=1.0):
+        """
+        Helper function that returns the objective of the calibration at the
+        given points (an ndarray of shape (G, 2) with a and sigma), all of
+        them are priced at once
+        """
+        param = (points[:, 0, None, None], points[:, 1, None, None])
+        errors = (self.cap_errors(param, notional), self.swaption_errors(param, notional))
+        return sum(np.sum(np.square(e), axis=-1) for e in errors)
+
+    def grid_search(self, a_values, sigma_values, notional=1.0, chunk_size=1000, processes=None):
+        """
+        Evaluates the objective of the calibration on a grid of a and sigma
+
+        Parameters
+        ----------
+            a_values : array_like of shape (A, ) with the values of a
+            sigma_values : array_like of shape (S, ) with the values of sigma
+            notional : notional of the caps and the swaptions, default value
+                is 1
+            chunk_size : number of grid points priced at once, default value
+                is 1000
+            processes : number of processes the chunks of the grid are
+                distributed over, by default they are priced in this process
+
+        Return
+        ------
+            out: ndarray of shape (A, S) with the sum of the squared errors
+
+        """
+        a, sigma = np.meshgrid(a_values, sigma_values, indexing='ij')
+        points = np.column_stack((a.ravel(), sigma.ravel()))
+        chunks = [points[start:start + chunk_size] for start in range(0, len(points), chunk_size)]
+        with np.errstate(all='ignore'):
+            if processes is None:
+                values = [self._grid_objective(chunk, notional) for chunk in chunks]
+            else:
+                with ProcessPoolExecutor(processes) as executor:
+                    values = list(executor.map(self._grid_objective, chunks,
+                                               [notional]*len(chunks)))
+        # the points where the formulas break down are never chosen
+        values = np.concatenate(values)
+        return np.where(np.isnan(values), np.inf, values).reshape(a.shape)
+
+    def calibration(self, initial=None, notional=1.0, method='SLSQP', display=False,
+                    a_values=None, sigma_values=None, starts=1, processes=None,
+                    bounds=((1.e-8, 2.0), (1.e-8, 0.5))):
         """
+        Calibrates a and sigma to the caps and the swaptions of the model,
+        inside the bounds of a and sigma. If initial is None the starting
+        points are the best points of a grid search (see grid_search), by
+        default a grid of 41 values of a between 1e-4 and 1 and of sigma
+        between 1e-4 and 0.1, the optimization is run from the best starts
+        points and the best result is kept. SLSQP can stop far from the
+        market (e.g. where all the model prices vanish and the relative
+        errors are stuck at 1) and still report convergence, so if the fit
+        from the given initial point is poor (a model price off its market
+        price by more than a factor 2, or a root mean squared relative error
+        above 1/2) it is run again from the grid search
         """
         EPSILON = 1.e-8
-        
-        resets = [] 
-        maturities = []
-        strikes = self._strikes
-        discounts_reset = []
-        discounts_maturity = []
-        
-        num_caps = len(self._black_prices)
-        
-        for j in range(num_caps):
-            resets.append(self._resets[:3 + j*4])
-            maturities.append(self._maturities[:3 + j*4])
-            discounts_reset.append(self._discounts_reset[:3 + j*4])
-            discounts_maturity.append(self._discounts_maturity[:3 + j*4])
-        
-        def func(param):
-            hw_prices = np.zeros(num_caps)
-            for i in range(num_caps):
+        MAX_RATIO = 2.0
 
-                hw_prices[i] = hw_cap(resets[i], maturities[i], notional, strikes[i], 
-                         discounts_reset[i], discounts_maturity[i], param[0], param[1])
-                
-            return sum(np.square((self._black_prices - hw_prices)/self._black_prices))
+        # objective and its analytic gradient with respect to a and sigma
+        def func(param):
+            cap_errors, cap_jac = self.cap_errors(param, notional, jac=True)
+            swaption_errors, swaption_jac = self.swaption_errors(param, notional, jac=True)
+            errors = np.append(cap_errors, swaption_errors)
+            jacobian = np.vstack((cap_jac, swaption_jac))
+            return np.sum(np.square(errors)), 2*np.dot(errors, jacobian)
     
         # setting up constraints as dictionary
         cons = ({'type': 'ineq',
-               'fun': lambda x: x[0] - EPSILON})
+               'fun': lambda x: x[0] - EPSILON}, )
+        # the critical rate of the Jamshidian decomposition needs sigma > 0
+        if self._swaptions is not None:
+            cons += ({'type': 'ineq',
+                    'fun': lambda x: x[1] - EPSILON}, )
         
+        def grid_starts():
+            a_grid = np.geomspace(1.e-4, 1, 41) if a_values is None else np.asarray(a_values)
+            sigma_grid = np.geomspace(1.e-4, 0.1, 41) if sigma_values is None else np.asarray(sigma_values)
+            objective = self.grid_search(a_grid, sigma_grid, notional, processes=processes)
+            best = np.argsort(objective, axis=None)[:starts]
+            a_index, sigma_index = np.unravel_index(best, objective.shape)
+            return np.column_stack((a_grid[a_index], sigma_grid[sigma_index]))
 
         # Sequential Least SQuares Programming (SLSQP)
-        result = minimize(func, initial, constraints=cons, method='SLSQP', options={'disp': True})
+        def optimize(initials, result=None):
+            for start in initials:
+                trial = minimize(func, start, jac=True, bounds=bounds, constraints=cons, method='SLSQP',
+                                 options={'disp': display})
+                if result is None or trial.fun < result.fun:
+                    result = trial
+            return result
+
+        if initial is None:
+            result = optimize(grid_starts())
+        else:
+            result = optimize([initial])
+            # the model prices are relative to the market prices, so 1 - error
+            # is the ratio of the model price to the market price
+            errors = np.append(self.cap_errors(result.x, notional), self.swaption_errors(result.x, notional))
+            ratios = 1 - errors
+            poor = np.any(ratios*MAX_RATIO < 1) or np.any(ratios > MAX_RATIO) or \
+                np.mean(np.square(errors)) > 0.25
+            if poor:
+                result = optimize(grid_starts(), result)
         self._a = result.x[0]
         self._sigma = result.x[1]
+        self._sigma_times = None
         return result
+
+    def bootstrap(self, a, notional=1.0, bracket=(1.e-6, 1.0)):
+        """
+        Calibrates a piecewise constant sigma to the caps for a given a, with
+        one root search per cap. The pieces of sigma end at the last reset of
+        every cap, so a cap only depends on the pieces up to its own and the
+        caps are fitted exactly one after the other, from the shortest one
+
+        Parameters
+        ----------
+            a : Hull-White parameter (a positive float)
+            notional : notional of the caps, default value is 1
+            bracket : lower and upper sigma of the root searches, default
+                value is (1e-6, 1)
+
+        Return
+        ------
+            out: tuple with the ndarrays of shape (C, ) with sigma and the
+                times where its pieces end, see hw_cap and HWTree
+
+        """
+        T0 = np.asarray(self._resets, dtype=float)
+        T1 = np.asarray(self._maturities, dtype=float)
+        P_T0 = np.asarray(self._discounts_reset, dtype=float)
+        P_T1 = np.asarray(self._discounts_maturity, dtype=float)
+        black_prices = np.asarray(self._black_prices, dtype=float)
+        strikes = np.asarray(self._strikes, dtype=float)
+
+        order = np.argsort(np.asarray(self._cap_maturities, dtype=float), kind='stable')
+        counts = self._caplet_counts[order]
+        if counts[0] == 0 or np.any(np.diff(counts) <= 0):
+            raise ValueError('every cap needs caplets after the ones of the previous cap')
+        sigma_times = T0[counts - 1]
+        sigmas = np.zeros(len(order))
+
+        for k, i in enumerate(order):
+            factor = notional*(1 + strikes[i]*(T1 - T0))
+            K = 1/(1 + strikes[i]*(T1 - T0))
+            # the caplets of the previous caps do not depend on the new piece
+            old = slice(0, counts[k - 1] if k > 0 else 0)
+            new = slice(old.stop, counts[k])
+            fixed = 0.0
+            if k > 0:
+                fixed = np.sum(factor[old]*ZBP(P_T0[old], P_T1[old], T0[old], T1[old], K[old], a,
+                                               sigmas[:k], sigma_times[:k]))
+
+            def cap_error(sigma):
+                sigmas[k] = sigma
+                caplets = factor[new]*ZBP(P_T0[new], P_T1[new], T0[new], T1[new], K[new], a,
+                                          sigmas[:k + 1], sigma_times[:k + 1])
+                return fixed + np.sum(caplets) - black_prices[i]
+
+            sigmas[k] = brentq(cap_error, *bracket)
+
+        self._a = a
+        self._sigma = sigmas
+        self._sigma_times = sigma_times
+        return sigmas, sigma_times
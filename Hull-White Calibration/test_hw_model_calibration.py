@@ -5,13 +5,37 @@ Created on Mon Nov 13 16:30:43 2017
 @author: Jesus
 """
 
+import numpy as np
 import pandas as pd
-from HWCalibration import HWModel
+from hw_calibration import HWModel
+from hull_white_formulas import hw_swaptions
 
-cap_data = pd.read_excel('data_test.xlsx',sheetname='cap_data')
-caplet_data = pd.read_excel('data_test.xlsx',sheetname='caplet_data')
+cap_data = pd.read_excel('data_test.xlsx',sheet_name='cap_data')
+caplet_data = pd.read_excel('data_test.xlsx',sheet_name='caplet_data')
 
 model = HWModel(cap_data, caplet_data)
 
 initial = [0.001,0.05]
-model.calibration(initial)
\ No newline at end of file
+model.calibration(initial)
+
+
+############################# SWAPTION CALIBRATION ############################
+
+# price a 10x10 matrix of swaptions with known a and sigma on a 20 years
+# curve, the calibration from the default initial point recovers them
+zcb_data = pd.DataFrame({'Maturity': np.arange(21.0)})
+zcb_data['ZCB'] = np.exp(-(0.02 + 0.001*zcb_data['Maturity'])*zcb_data['Maturity'])
+
+expiries, tenors = np.meshgrid(np.arange(1, 11), np.arange(1, 11), indexing='ij')
+swaption_data = pd.DataFrame({'Expiry': expiries.ravel(), 'Tenor': tenors.ravel(),
+                              'Strike': 0.03})
+a, sigma = 0.05, 0.01
+swaption_data['Swaption'] = hw_swaptions(swaption_data['Expiry'], swaption_data['Tenor'],
+                                         swaption_data['Strike'], zcb_data['Maturity'],
+                                         zcb_data['ZCB'], a, sigma)
+
+swaption_model = HWModel(swaption_data=swaption_data, zcb_data=zcb_data)
+result = swaption_model.calibration(initial)
+print('a: {:1.6f} (true {}), sigma: {:1.6f} (true {})'.format(result.x[0], a, result.x[1], sigma))
+assert result.success
+assert np.allclose(result.x, [a, sigma], rtol=1.e-3)
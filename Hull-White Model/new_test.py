@@ -5,11 +5,15 @@ Created on Sun Nov 19 18:57:18 2017
 @author: Jesus
 """
 
+import numpy as np
 import pandas as pd
-from simple_hull_white import HWTree
+from simple_hull_white import HWTree, event_time_grid
 from simple_payoff import PayerSwaption, CapletPayoff, FloorletPayoff
 from simple_bond import ZCBond, Bond
 from simple_derivatives import SimpleDerivative, SimpleSwaption, CallableBond
+from simple_lsm import LSMPricer
+from simple_finite_difference import HWFiniteDifference
+from simple_portfolio import Portfolio
 
 ############################### HULL-WHITE TREE ###############################
 
@@ -194,4 +198,85 @@ callable_bond = CallableBond(payment_dates, payment_steps, exercise_dates,
 
 # get the Callable Bond price
 
-print('Callable Bond price: {:1.8f}'.format(callable_bond.get_price(hw)))
\ No newline at end of file
+print('Callable Bond price: {:1.8f}'.format(callable_bond.get_price(hw)))
+
+################### BERMUDAN SWAPTIONS ON A NON-UNIFORM GRID ##################
+
+# build a grid with a node at every payment and exercise date, the steps are
+# short next to those dates and longer in between
+today = pd.read_excel('sample_data.xlsx', sheetname='tree_dates')['Tree Dates'][0]
+payment_times = (pd.to_datetime(bermudan_payment_dates['Payment Date']) - today).dt.days/365.0
+exercise_times = (pd.to_datetime(bermudan_exercise_dates['Exercise Date']) - today).dt.days/365.0
+time_grid = event_time_grid(pd.concat([payment_times, exercise_times]), 1/48, 0.25)
+
+hw_grid = HWTree(zcb_prices, zcb_maturities, maturity, steps, a, sigma, 
+                 time_grid=time_grid)
+
+# the payment and exercise steps are taken from the grid
+payment_steps = pd.Series(hw_grid.time_steps(payment_times))
+exercise_steps = pd.Series(hw_grid.time_steps(exercise_times))
+
+swaption = SimpleSwaption(bermudan_payment_dates['Payment Date'], payment_steps,
+                          bermudan_exercise_dates['Exercise Date'], 
+                          exercise_steps, frequency=4)
+
+strike = 0.013122450511296
+payoff = PayerSwaption(strike)
+print('Bermudan Swaption price (non-uniform grid): {:1.8f}'.format(swaption.get_price(hw_grid, payoff)))
+
+
+################## LEAST SQUARES MONTE CARLO (Bermudan products) ##############
+
+# simulate the short rate on the time slices of the tree and price the
+# Bermudan swaption and the callable bond by regression, the prices should
+# agree with the tree within a few standard errors plus the time step error
+# of the tree
+lsm = LSMPricer(zcb_prices, zcb_maturities, a, sigma, np.linspace(0, maturity, steps + 1),
+                seed=2017)
+
+swaption = SimpleSwaption(bermudan_payment_dates['Payment Date'], 
+                          bermudan_payment_dates['Payment Step'],
+                          bermudan_exercise_dates['Exercise Date'], 
+                          bermudan_exercise_dates['Exercise Step'], frequency=4)
+payoff = PayerSwaption(strike)
+print('Bermudan Swaption price (tree): {:1.8f}'.format(swaption.get_price(hw, payoff)))
+print('Bermudan Swaption price (LSM) : {:1.8f} +/- {:1.8f}'.format(
+        lsm.get_price(swaption, payoff), lsm.standard_error()))
+
+callable_payment_dates = pd.read_excel('sample_data.xlsx', 
+                                       sheetname='callable_payment_dates')
+callable_bond = CallableBond(pd.to_datetime(callable_payment_dates['Payment Date']),
+                             callable_payment_dates['Payment Step'],
+                             pd.to_datetime(callable_exercise_dates['Exercise Date']),
+                             callable_exercise_dates['Exercise Step'],
+                             callable_payment_dates['Coupon'], frequency=2)
+print('Callable Bond price (tree): {:1.8f}'.format(callable_bond.get_price(hw)))
+print('Callable Bond price (LSM) : {:1.8f} +/- {:1.8f}'.format(
+        lsm.get_price(callable_bond), lsm.standard_error()))
+
+
+######################## FINITE DIFFERENCES (all products) ####################
+
+# solve the Hull-White PDE on the same time slices, the products are priced
+# with the same payment and exercise steps as on the tree
+fd = HWFiniteDifference(zcb_prices, zcb_maturities, maturity, steps, a, sigma)
+
+coupon_bond = Bond(bond_dates['Payment Date'], bond_dates['Payment Step'], 
+                   bond_dates['Coupon'], frequency=2)
+caplet = SimpleDerivative(pd.to_datetime(caplet_dates['Payment Date']), 
+                          caplet_dates['Payment Step'],
+                          pd.to_datetime(caplet_dates['Reset Date']), 
+                          caplet_dates['Reset Step'])
+
+# the whole book is priced with one backward induction on each engine, on
+# this coarse grid the caplet of the tree is about 9% below the converged
+# price and the one of the grid about 0.6%
+names = ['Bond', 'Caplet', 'Bermudan Swaption', 'Callable Bond']
+portfolio = Portfolio()
+portfolio.add(coupon_bond)
+portfolio.add(caplet, CapletPayoff(0.00955952490457184))
+portfolio.add(swaption, PayerSwaption(strike))
+portfolio.add(callable_bond)
+
+for name, tree_price, fd_price in zip(names, portfolio.get_prices(hw), fd.get_prices(portfolio)):
+    print('{} price (tree / FD): {:1.8f} / {:1.8f}'.format(name, tree_price, fd_price))
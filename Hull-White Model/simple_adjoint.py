@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Adjoint sensitivities of tree prices to the ZCB prices, a and sigma
+"""
+
+import numpy as np
+from simple_rollback import RollbackEngine
+
+
+class AdjointEngine(object):
+    """
+    Adjoint (reverse mode) sensitivities of the prices of a Hull-White tree.
+    The calibrated tree is the record of the forward induction (Arrow-Debreu
+    prices and discount factors) and the backward induction of the products is
+    recorded while it is carried out, then one reverse sweep through the
+    backward induction and the calibration returns the derivatives of every
+    price with respect to all the ZCB prices, a and sigma.
+    The derivative with respect to a keeps the branching of the tree fixed,
+    the central states and jmax only change at isolated values of a
+
+    """
+
+    def __init__(self, hw_tree, step=1.e-20):
+        """
+        Initialize an AdjointEngine object
+
+        Parameters
+        ----------
+            hw_tree: a HWTree class instance, it is calibrated (through the
+                tree cache) if needed
+            step : imaginary step used to differentiate the product events
+                (coupons, exercise decisions, payoffs), which are functions of
+                the values of each node, default value is 1e-20
+
+        """
+        # the derivative with respect to sigma scales the spacing of the states
+        # of a single sigma
+        if hw_tree._sigma_times is not None:
+            raise ValueError('the adjoint sensitivities need a constant sigma, the tree has sigma_times')
+        self._engine = RollbackEngine(hw_tree)
+        self._hw_tree = hw_tree
+        self._step = step
+
+    def get_sensitivities(self, instrument, payoff=None):
+        """
+        This function computes the price of a product and its sensitivities
+
+        Parameters
+        ----------
+            instrument: a ZCBond, Bond, SimpleDerivative, SimpleSwaption or
+                CallableBond class instance
+            payoff: a PayOff class instance, only for SimpleDerivative and
+                SimpleSwaption
+
+        Return
+        ------
+            out: dictionary with the price, the derivatives with respect to the
+                ZCB prices (ndarray of shape (M, )) and the derivatives with
+                respect to a and sigma
+
+        """
+        start, width, instrument_events = instrument._portfolio_events(payoff)
+        block = slice(0, width)
+        events = {i: [(block, event)] for i, event in instrument_events.items()}
+        sensitivities = self.sensitivities(start, width, [width - 1], events)
+        return {key: value[0] for key, value in sensitivities.items()}
+
+    def sensitivities(self, start, num_columns, columns, events):
+        """
+        Computes the prices and the sensitivities of a set of products whose
+        values are stacked as columns (see Portfolio)
+
+        Parameters
+        ----------
+            start : time slice where the backward induction starts
+            num_columns : number of columns of the node values
+            columns : list with the column of the price of every product
+            events : dictionary that maps time slices to lists of (block,
+                event) pairs, the event callable sets the columns of the block
+
+        Return
+        ------
+            out: dictionary with the prices (ndarray of shape (N, )), the
+                derivatives with respect to the ZCB prices (ndarray of shape
+                (N, M)) and the derivatives with respect to a and sigma
+                (ndarrays of shape (N, ))
+
+        """
+        # every product owns the columns of its blocks, so the adjoints of the
+        # columns are summed product by product
+        owners = np.zeros((num_columns, len(columns)))
+        for product, (first, last) in enumerate(zip([-1] + columns[:-1], columns)):
+            owners[first + 1:last + 1, product] = 1
+
+        tape, prices = self._backward_induction(start, num_columns, events)
+        df_adjoints, a_adjoint = self._reverse_rollback(tape, columns, owners)
+        zcb_adjoint, a_calibration, sigma_adjoint = self._reverse_calibration(df_adjoints)
+
+        return {'price': prices[columns],
+                'zcb_prices': zcb_adjoint.T,
+                'a': a_adjoint + a_calibration,
+                'sigma': sigma_adjoint}
+
+    def _backward_induction(self, start, num_columns, events):
+        """
+        Helper function that carries out the backward induction and records
+        the node values of every time slice, the expected values and the
+        jacobians of the events
+        """
+        engine = self._engine
+        engine.require(start)
+        values = np.zeros((len(engine.states(start)), num_columns))
+        values, _ = self._apply_events(start, values, events)
+
+        tape = []
+        for i in reversed(range(start)):
+            expected = self._hw_tree._backward_induction(i, values)
+            discounted = expected*engine.discount_factors(i)[:, None]
+            next_values = values
+            values, jacobians = self._apply_events(i, discounted, events)
+            tape.append((i, next_values, expected, jacobians))
+
+        return tape[::-1], values[0]
+
+    def _apply_events(self, i, values, events):
+        """
+        Helper function that applies the events of the time slice i and
+        returns the jacobians of the events at every node. The events act on
+        each node separately, so the jacobian of a block of K columns is found
+        with K complex step evaluations
+        """
+        jacobians = []
+        for block, event in events.get(i, []):
+            width = block.stop - block.start
+            jacobian = np.zeros((len(values), width, width))
+            for column in range(width):
+                bumped = values[:, block].astype(complex)
+                bumped[:, column] += 1j*self._step
+                result = np.asarray(event(i, bumped))
+                jacobian[:, :, column] = result.imag/self._step
+            values = values.copy()
+            values[:, block] = result.real
+            jacobians.append((block, jacobian))
+        return values, jacobians
+
+    def _reverse_rollback(self, tape, columns, owners):
+        """
+        Helper function that sweeps the backward induction in reverse, it
+        returns the adjoints of the discount factors of every time slice and
+        the adjoint of a through the probabilities
+        """
+        hw_tree = self._hw_tree
+        engine = self._engine
+        adjoint = np.zeros((1, owners.shape[0]))
+        adjoint[0, columns] = 1
+        a_adjoint = np.zeros(len(columns))
+
+        df_adjoints = []
+        for i, next_values, expected, jacobians in tape:
+            for block, jacobian in jacobians:
+                adjoint = adjoint.copy()
+                adjoint[:, block] = np.einsum('nrc,nr->nc', jacobian, adjoint[:, block])
+            df_adjoints.append(np.dot(adjoint*expected, owners))
+
+            # the expected values are a banded product of the probabilities and
+            # the node values of the next time slice
+            expected_adjoint = adjoint*engine.discount_factors(i)[:, None]
+            operator = hw_tree._operators[i]
+            half_width = hw_tree.half_width(i)
+            centres = operator._centres[operator._window(half_width)] + (len(next_values) - 1)//2
+            derivatives = operator.prob_derivative(half_width)
+            for band in range(3):
+                prob_adjoint = np.dot(expected_adjoint*next_values[centres + band - 1], owners)
+                a_adjoint += np.dot(derivatives[band], prob_adjoint)
+            adjoint = operator.forward(expected_adjoint, hw_tree.half_width(i + 1))
+
+        return df_adjoints, a_adjoint
+
+    def _reverse_calibration(self, df_adjoints):
+        """
+        Helper function that sweeps the calibration in reverse. The discount
+        factors of the time slice i are d = P(t_{i+1})/S*g with g = exp(-j*dx*dt)
+        and S the sum of the Arrow-Debreu prices times g, and the Arrow-Debreu
+        prices of the time slice i + 1 are the forward induction of Q*d
+        """
+        hw_tree = self._hw_tree
+        offset = hw_tree._offset
+        zcb_prices = hw_tree._zcb_grid_prices()
+        num_products = df_adjoints[0].shape[1] if df_adjoints else 0
+        zcb_adjoint = np.zeros((len(zcb_prices), num_products))
+        a_adjoint = np.zeros(num_products)
+        sigma_adjoint = np.zeros(num_products)
+
+        state_price_adjoint = None
+        for i in reversed(range(len(df_adjoints))):
+            half_width = hw_tree.half_width(i)
+            states = np.arange(-half_width, half_width + 1)
+            nodes = slice(offset - half_width, offset + half_width + 1)
+            state_prices = hw_tree._state_prices[i, nodes]
+            discount_factors = hw_tree._discount_factors[i, nodes]
+            weights = state_prices*discount_factors
+            df_adjoint = df_adjoints[i]
+
+            # forward induction from the time slice i to the time slice i + 1
+            operator = hw_tree._operators[i]
+            if state_price_adjoint is None:
+                state_price_adjoint = np.zeros((len(states), num_products))
+            else:
+                centres = operator._centres[operator._window(half_width)] + (len(state_price_adjoint) - 1)//2
+                derivatives = operator.prob_derivative(half_width)
+                for band in range(3):
+                    a_adjoint += np.dot(derivatives[band]*weights, state_price_adjoint[centres + band - 1])
+                weights_adjoint = operator.backward(state_price_adjoint, half_width)
+                df_adjoint = df_adjoint + weights_adjoint*state_prices[:, None]
+                state_price_adjoint = weights_adjoint*discount_factors[:, None]
+
+            # calibration of the time slice i to the ZCB price of the time
+            # slice i + 1
+            dt = hw_tree._dts[i]
+            g = np.exp(-states*hw_tree._dxs[i]*dt)
+            total = np.dot(state_prices, g)
+            scale = zcb_prices[i + 1]/total
+            scale_adjoint = np.dot(g, df_adjoint)
+            g_adjoint = df_adjoint*scale
+            zcb_adjoint[i + 1] += scale_adjoint/total
+            total_adjoint = -scale_adjoint*scale/total
+            state_price_adjoint = state_price_adjoint + np.outer(g, total_adjoint)
+            g_adjoint = g_adjoint + np.outer(state_prices, total_adjoint)
+
+            # the spacing dx of the states is proportional to sigma
+            dx_adjoint = np.dot(-states*dt*g, g_adjoint)
+            sigma_adjoint += dx_adjoint*hw_tree._dxs[i]/hw_tree._sigma
+
+        return self._input_zcb_adjoint(zcb_adjoint), a_adjoint, sigma_adjoint
+
+    def _input_zcb_adjoint(self, zcb_adjoint):
+        """
+        Helper function that maps the adjoints of the ZCB prices of the time
+        slices to the input ZCB prices. On a uniform grid they are the same,
+        on a non-uniform grid the log prices were linearly interpolated
+        """
+        hw_tree = self._hw_tree
+        prices = np.asarray(hw_tree._zcb_prices, dtype=float)
+        if hw_tree._time_grid is None:
+            return zcb_adjoint
+
+        maturities = np.asarray(hw_tree._zcb_maturities, dtype=float)
+        times = np.clip(hw_tree._times, maturities[0], maturities[-1])
+        lower = np.clip(np.searchsorted(maturities, times, side='right') - 1, 0, len(maturities) - 2)
+        weight = (times - maturities[lower])/(maturities[lower + 1] - maturities[lower])
+        log_adjoint = zcb_adjoint*hw_tree._zcb_grid_prices()[:, None]
+
+        input_adjoint = np.zeros((len(prices), zcb_adjoint.shape[1]))
+        np.add.at(input_adjoint, lower, log_adjoint*(1 - weight)[:, None])
+        np.add.at(input_adjoint, lower + 1, log_adjoint*weight[:, None])
+        return input_adjoint/prices[:, None]
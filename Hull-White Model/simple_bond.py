@@ -5,6 +5,10 @@ Created on Thu Nov  2 16:49:06 2017
 @author: Jesus
 """
 
+import numpy as np
+from simple_rollback import RollbackEngine
+from simple_tree_cache import TREE_CACHE
+
 class ZCBond(object):
     """
     Representation of a Zero Coupon Bond
@@ -34,7 +38,8 @@ class ZCBond(object):
     
     def build_hw_tree(self, hw_tree):
         """
-        Helper function that builds and calibrate a Hull-White tree
+        Helper function that builds and calibrates a Hull-White tree up to the
+        maturity of the bond
         
         Parameters
         ----------
@@ -42,8 +47,7 @@ class ZCBond(object):
             
         """
         if not hw_tree._is_built:
-            hw_tree.hw_prob()
-            hw_tree.calibrate()
+            TREE_CACHE.calibrate(hw_tree, self._steps)
     
     def get_price(self, hw_tree):
         """
@@ -60,29 +64,29 @@ class ZCBond(object):
         """
         # Build the HW tree
         self.build_hw_tree(hw_tree)
+        engine = RollbackEngine(hw_tree)
 
-        # construct the bond tree
-        for i in reversed(range(self._steps + 1)):
-            for j in range(-i, i + 1):
-                # if this is the final node, then set the bond final payoff
-                if i == self._steps:
-                    self._bond_tree[i, j] = 1
-                    continue
-                # else, compute the discounted expected value
-                else:
-                    discounted_expected_value = 0
-                    for k in range(j - 2, j + 3):
-                        if k <= i + 1 and k >= -i - 1:
-                            discounted_expected_value += hw_tree.prob(j, k)*self._bond_tree[i + 1, k]
-                        else:
-                            continue
-                    discounted_expected_value *= hw_tree._discount_factor_tree[i, j]
-                    
-                    # set the node value as the disccounted expected value
-                    self._bond_tree[i, j] = discounted_expected_value
+        # construct the bond tree, the final payoff is the face value and the
+        # other nodes are the discounted expected values
+        final_payoff = np.ones(len(engine.states(self._steps)))
+        self._bond_tree = engine.rollback_tree(final_payoff, self._steps)
 
         return self._bond_tree[0, 0]
 
+    def _portfolio_events(self, payoff=None):
+        """
+        Helper function that describes the bond to a Portfolio: the time slice
+        where its backward induction starts, its number of columns and the
+        events applied to those columns
+        """
+        return self._steps, 1, {self._steps: self._set_final_payoff}
+
+    def _set_final_payoff(self, i, values):
+        """
+        Helper function that sets the face value at the maturity node
+        """
+        return np.ones_like(values)
+
 
 class Bond(object):
     """
@@ -111,11 +115,13 @@ class Bond(object):
         self._steps = payment_steps[len(payment_steps) - 1]
         self._coupon_rates = coupon_rates
         self._frequency = frequency
+        self._coupons = None
         self._bond_tree = {}
     
     def build_hw_tree(self, hw_tree):
         """
-        Helper function that builds and calibrate a Hull-White tree
+        Helper function that builds and calibrates a Hull-White tree up to the
+        maturity of the bond
         
         Parameters
         ----------
@@ -123,8 +129,7 @@ class Bond(object):
             
         """
         if not hw_tree._is_built:
-            hw_tree.hw_prob()
-            hw_tree.calibrate()
+            TREE_CACHE.calibrate(hw_tree, self._steps)
     
     def get_price(self, hw_tree):
         """
@@ -141,33 +146,46 @@ class Bond(object):
         """
         # Build the HW tree
         self.build_hw_tree(hw_tree)
+        engine = RollbackEngine(hw_tree)
+
+        # construct the bond tree, the final payoff is the face value plus the
+        # last coupon and the coupon payment is added at every payment node
+        final_payoff = np.ones(len(engine.states(self._steps)))*(1 + self.coupon(self._steps))
+        events = {i: self._add_coupon for i in self._payment_steps.tolist() if i < self._steps}
+        self._bond_tree = engine.rollback_tree(final_payoff, self._steps, events)
 
-        # construct the bond tree
-        for i in reversed(range(self._steps + 1)):
-            for j in range(-i, i + 1):
-                # if this is the final node, then set the bond final payoff
-                if i == self._steps:
-                    index = self._payment_steps.tolist().index(i)
-                    self._bond_tree[i, j] = 1 + self._coupon_rates[index]/self._frequency
-                    continue
-                # else, compute the discounted expected value
-                else:
-                    discounted_expected_value = 0
-                    for k in range(j - 2, j + 3):
-                        if k <= i + 1 and k >= -i - 1:
-                            discounted_expected_value += hw_tree.prob(j, k)*self._bond_tree[i + 1, k]
-                        else:
-                            continue
-                    discounted_expected_value *= hw_tree._discount_factor_tree[i, j]
-                
-                    # if this is a payment node, then add the coupon payment to 
-                    # the discounted expected value and set this value as the node
-                    # value
-                    if i in self._payment_steps.tolist():
-                        index = self._payment_steps.tolist().index(i)
-                        self._bond_tree[i, j] = discounted_expected_value + self._coupon_rates[index]/self._frequency
-                    # else, set the discounted expected value as the node value
-                    else:
-                        self._bond_tree[i, j] = discounted_expected_value
-
-        return self._bond_tree[0, 0]
\ No newline at end of file
+        return self._bond_tree[0, 0]
+
+    def _portfolio_events(self, payoff=None):
+        """
+        Helper function that describes the bond to a Portfolio: the time slice
+        where its backward induction starts, its number of columns and the
+        events applied to those columns
+        """
+        events = {i: self._add_coupon for i in self._payment_steps.tolist() if i < self._steps}
+        events[self._steps] = self._set_final_payoff
+        return self._steps, 1, events
+
+    def _set_final_payoff(self, i, values):
+        """
+        Helper function that sets the face value plus the last coupon at the
+        maturity node
+        """
+        return np.ones_like(values)*(1 + self.coupon(i))
+
+    def coupon(self, i):
+        """
+        Returns the coupon payment at the payment step i
+        """
+        if self._coupons is None:
+            self._coupons = {}
+            for index, step in enumerate(self._payment_steps.tolist()):
+                self._coupons.setdefault(step, self._coupon_rates[index]/self._frequency)
+        return self._coupons[i]
+
+    def _add_coupon(self, i, values):
+        """
+        Helper function that adds the coupon payment to the node values of a
+        payment step
+        """
+        return values + self.coupon(i)
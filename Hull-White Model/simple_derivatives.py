@@ -11,8 +11,10 @@ path = os.getcwd() + '/isda_daycounters/'
 #print(path)
 sys.path.insert(0, path)
 import thirty360, actual360
+import copy
 import numpy as np
 from simple_bond import Bond, ZCBond
+from simple_rollback import RollbackEngine
 
 
 class SimpleDerivative(object):
@@ -67,32 +69,44 @@ class SimpleDerivative(object):
         bond = ZCBond(self._payment_date, self._payment_step)
         bond.get_price(hw_tree)
         
-        # construct the derivative tree
-        for i in reversed(range(self._steps + 1)):
-            for j in range(-i, i + 1):
-                # if this is the first exercise node, then set the 
-                # derivative payoff
-                if i == self._steps:
-                    price = bond._bond_tree[i, j]
-                    tau = actual360.year_fraction(self._reset_date[0], self._payment_date[0])
-                    self._the_tree[i, j] = payoff(price, tau)
-                    continue
-                
-                # else, compute the discounted expected value (continuation value)
-                else:
-                    continuation_value = 0
-                    for k in range(j - 2, j + 3):
-                        if k <= i + 1 and k >= -i - 1:
-                            continuation_value += hw_tree.prob(j, k)*self._the_tree[i + 1, k]
-                        else:
-                            continue
-                    continuation_value *= hw_tree._discount_factor_tree[i, j]
-                    
-
-                    self._the_tree[i, j] = continuation_value
+        # construct the derivative tree, the payoff is set at the reset node
+        # and the other nodes are the discounted expected values
+        engine = RollbackEngine(hw_tree)
+        price = bond._bond_tree.slice(self._steps)
+        tau = actual360.year_fraction(self._reset_date[0], self._payment_date[0])
+        self._the_tree = engine.rollback_tree(payoff(price, tau), self._steps)
 
         return self._the_tree[0, 0]
 
+    def _portfolio_events(self, payoff):
+        """
+        Helper function that describes the derivative to a Portfolio: the time
+        slice where its backward induction starts, its number of columns (the
+        underlying bond and the derivative) and the events applied to those
+        columns
+        """
+        # the events are bound to a copy, so the same derivative can be added
+        # with different payoffs
+        derivative = copy.copy(self)
+        derivative._bond = ZCBond(self._payment_date, self._payment_step)
+        derivative._payoff = payoff
+        derivative._bond_events = derivative._bond._portfolio_events()[2]
+        events = dict.fromkeys(derivative._bond_events, derivative._portfolio_event)
+        events[self._steps] = derivative._portfolio_event
+        return derivative._bond._steps, 2, events
+
+    def _portfolio_event(self, i, values):
+        """
+        Helper function that applies the bond events and sets the payoff at the
+        reset node
+        """
+        if i in self._bond_events:
+            values[:, :1] = self._bond_events[i](i, values[:, :1])
+        if i == self._steps:
+            tau = actual360.year_fraction(self._reset_date[0], self._payment_date[0])
+            values[:, 1:] = self._payoff(values[:, :1], tau)
+        return values
+
 
 class SimpleSwaption(object):
     """
@@ -147,46 +161,86 @@ class SimpleSwaption(object):
         bond = Bond(self._payment_dates, self._payment_steps, coupon_rates, self._frequency)
         bond.get_price(hw_tree)
         
-        # construct the derivative tree
-        for i in reversed(range(self._steps + 1)):
-            for j in range(-i, i + 1):
-                # if this is the first exercise node, then set the 
-                # derivative payoff
-                if i == self._steps:
-                    index = bond._payment_steps.tolist().index(i)
-                    price = bond._bond_tree[i, j] - bond._coupon_rates[index]/bond._frequency
-                    self._the_tree[i, j] = payoff(price)
-                    continue
-                
-                # else, compute the discounted expected value (continuation value)
-                else:
-                    continuation_value = 0
-                    for k in range(j - 2, j + 3):
-                        if k <= i + 1 and k >= -i - 1:
-                            continuation_value += hw_tree.prob(j, k)*self._the_tree[i + 1, k]
-                        else:
-                            continue
-                    continuation_value *= hw_tree._discount_factor_tree[i, j]
-                    
-                    # if this is an exercise node
-                    if i in self._exercise_steps.tolist():
-                        # and payment node, then subtract the 
-                        # coupon payment from the bond price at that node
-                        if i in self._payment_steps.tolist():    
-                            index = bond._payment_steps.tolist().index(i)
-                            price = bond._bond_tree[i, j] - bond._coupon_rates[index]/bond._frequency
-                        else:
-                            price = bond._bond_tree[i, j]
-                        
-                        # set the node value comparing the continuation value with 
-                        # call value
-                        call_value = payoff(price)
-                        self._the_tree[i, j] = max(continuation_value, call_value)
-                    else:
-                        # else this is the discounted continuation value
-                        self._the_tree[i, j] = continuation_value
+        # construct the derivative tree, the payoff is set at the last exercise
+        # node and the exercise decision is taken at every exercise node
+        engine = RollbackEngine(hw_tree)
+        self._bond = bond
+        self._payoff = payoff
+        final_payoff = payoff(self._underlying_price(self._steps, bond._bond_tree.slice(self._steps)))
+        events = {i: self._exercise for i in self._exercise_steps.tolist() if i < self._steps}
+        self._the_tree = engine.rollback_tree(final_payoff, self._steps, events)
 
         return self._the_tree[0, 0]
+
+    def _underlying_price(self, i, bond_price):
+        """
+        Helper function that returns the bond price at the exercise step i, if
+        this is a payment node the coupon payment is subtracted
+        """
+        if i in self._payment_steps.tolist():
+            bond_price = bond_price - self._bond.coupon(i)
+        return bond_price
+
+    def _exercise(self, i, continuation_value, bond_price=None):
+        """
+        Helper function that sets the node values of an exercise step comparing
+        the continuation value with the call value
+        """
+        if bond_price is None:
+            bond_price = self._bond._bond_tree.slice(i)
+        call_value = self._payoff(self._underlying_price(i, bond_price))
+        return np.maximum(continuation_value, call_value)
+
+    def _lsm_schedule(self, payoff):
+        """
+        Helper function that describes the swaption to a LSMPricer: the
+        underlying bond, the exercise steps, the exercise value of an exercise
+        step as a function of the bond price after the payment of the step,
+        and whether the option is short (the holder owns the swaption, so it is
+        not)
+        """
+        swaption = copy.copy(self)
+        coupon_rates = np.ones_like(self._payment_steps)*payoff._strike
+        swaption._bond = Bond(self._payment_dates, self._payment_steps, coupon_rates, self._frequency)
+        swaption._payoff = payoff
+        return swaption._bond, np.asarray(self._exercise_steps), swaption._lsm_exercise, False
+
+    def _lsm_exercise(self, i, bond_price):
+        """
+        Helper function that returns the exercise value of the exercise step i
+        """
+        return self._payoff(bond_price)
+
+    def _portfolio_events(self, payoff):
+        """
+        Helper function that describes the swaption to a Portfolio: the time
+        slice where its backward induction starts, its number of columns (the
+        underlying bond and the swaption) and the events applied to those
+        columns
+        """
+        # the events are bound to a copy, so the same swaption can be added
+        # with different payoffs
+        swaption = copy.copy(self)
+        coupon_rates = np.ones_like(self._payment_steps)*payoff._strike
+        swaption._bond = Bond(self._payment_dates, self._payment_steps, coupon_rates, self._frequency)
+        swaption._payoff = payoff
+        swaption._bond_events = swaption._bond._portfolio_events()[2]
+        events = dict.fromkeys(swaption._bond_events, swaption._portfolio_event)
+        events.update(dict.fromkeys(self._exercise_steps.tolist(), swaption._portfolio_event))
+        return swaption._bond._steps, 2, events
+
+    def _portfolio_event(self, i, values):
+        """
+        Helper function that applies the bond events and the exercise decision
+        of the swaption
+        """
+        if i in self._bond_events:
+            values[:, :1] = self._bond_events[i](i, values[:, :1])
+        if i == self._steps:
+            values[:, 1:] = self._payoff(self._underlying_price(i, values[:, :1]))
+        elif i < self._steps and i in self._exercise_steps.tolist():
+            values[:, 1:] = self._exercise(i, values[:, 1:], values[:, :1])
+        return values
     
 
 class CallableBond(object):
@@ -229,58 +283,104 @@ class CallableBond(object):
         bond = Bond(self._payment_dates, self._payment_steps, self._coupon_rates, self._frequency)
         bond.get_price(hw_tree)
         
-        # construct the tree
+        # construct the tree, the last node values are the bond values one step
+        # after the last exercise step
+        engine = RollbackEngine(hw_tree)
+        self._bond = bond
+        final_values = bond._bond_tree.slice(self._steps + 1)
+        events = {i: self._event for i in self._exercise_steps.tolist() + self._payment_steps.tolist() if i <= self._steps}
+        self._the_tree = engine.rollback_tree(final_values, self._steps + 1, events)
+
+        return self._the_tree[0, 0]
+
+    def _event(self, i, discounted_expected_value):
+        """
+        Helper function that sets the node values of a payment or exercise step
+        """
+        bond = self._bond
+        # if this is an exercise node
+        if i in self._exercise_steps.tolist():
+            # and a payment node, compute the continuation value adding the
+            # coupon payment to the discounted value, the call value is the face
+            # value plus coupon payment
+            if i in self._payment_steps.tolist():
+                continuation_value = discounted_expected_value + bond.coupon(i)
+                call_value = self._call_price(i) + bond.coupon(i)
+
+            # else, continuation value is the discounted expected value and the
+            # call value is the face value plus accrued interest
+            else:
+                continuation_value = discounted_expected_value
+                call_value = self._call_price(i)
+            return np.minimum(continuation_value, call_value)
+
+        # else, this is a payment node and the node value is the discounted
+        # expected value plus coupon payment
+        else:
+            return discounted_expected_value + bond.coupon(i)
+
+    def _call_price(self, i):
+        """
+        Helper function that returns the call price of the exercise step i
+        without the coupon payment of the step: the face value on a payment
+        step and the face value plus accrued interest otherwise
+        """
         face_value = 1.0
-        
-        for i in reversed(range(self._steps + 2)):
-            for j in range(-i, i + 1):
-                if i == self._steps + 1:              
-                    self._the_tree[i, j] = bond._bond_tree[i, j]
-                    continue
-                else:
-                    discounted_expected_value = 0
-                    for k in range(j - 2, j + 3):
-                        if k <= i + 1 and k >= -i - 1:
-                            discounted_expected_value += hw_tree.prob(j, k)*self._the_tree[i + 1, k]
-                        else:
-                            continue
-                            
-                    discounted_expected_value *= hw_tree._discount_factor_tree[i, j]
-                    # if this is an exercise node
-                    if i in self._exercise_steps.tolist():
-                        # and a payment node, compute the continuation value
-                        # adding the coupon payment to the discounted value
-                        # the call value is the face value plus coupon payment
-                        if i in self._payment_steps.tolist():
-                            index = bond._payment_steps.tolist().index(i)
-                            coupon_rate = bond._coupon_rates[index]
-                            continuation_value = discounted_expected_value + coupon_rate/bond._frequency
-                            call_value = face_value + coupon_rate/bond._frequency
-                            self._the_tree[i, j] = min(continuation_value, call_value)
-                    
-                    # else, continuation value is the discounted expected
-                        # value and the call value is the face value plus accrued
-                        # interest
-                        else:
-                            index = abs(bond._payment_steps[::-1]-39).argmin() # TODO this thing
-                            coupon_rate = bond._coupon_rates[index]
-                            e_index = self._exercise_steps.tolist().index(i)
-                            accrued_interest = coupon_rate*thirty360.year_fraction(self._payment_dates[index - 1], self._exercise_dates[e_index])
-                            continuation_value = discounted_expected_value
-                            call_value = face_value + accrued_interest
-                            self._the_tree[i, j] = min(continuation_value, call_value)
-                    
-                    # else, 
-                    else:
-                        # if this is a payment node, set the node value as the
-                        # discounted expected value plus coupon payment
-                        if i in self._payment_steps.tolist():
-                            index = bond._payment_steps.tolist().index(i)
-                            coupon_rate = bond._coupon_rates[index]
-                            self._the_tree[i, j] = discounted_expected_value + coupon_rate/bond._frequency
-                        
-                        # else, set the node value as the discounted expected value
-                        else:
-                            self._the_tree[i, j] = discounted_expected_value
-                
-        return self._the_tree[0, 0]
\ No newline at end of file
+        if i in self._payment_steps.tolist():
+            return face_value
+        # the interest accrues from the last payment before the exercise step
+        # at the rate of the coupon paid at the end of the period
+        index = np.searchsorted(np.asarray(self._payment_steps), i) - 1
+        if index < 0 or index + 1 >= len(self._payment_steps):
+            raise ValueError('the exercise step {} is not between two payment steps'.format(i))
+        coupon_rate = self._coupon_rates[index + 1]
+        e_index = self._exercise_steps.tolist().index(i)
+        accrued_interest = coupon_rate*thirty360.year_fraction(self._payment_dates[index], self._exercise_dates[e_index])
+        return face_value + accrued_interest
+
+    def _lsm_schedule(self, payoff=None):
+        """
+        Helper function that describes the callable bond to a LSMPricer: the
+        underlying bond, the exercise steps, the exercise value of the call of
+        an exercise step as a function of the bond price after the payment of
+        the step, and whether the option is short (the issuer holds the call,
+        so the price is the bond price minus the call price)
+        """
+        callable_bond = copy.copy(self)
+        callable_bond._bond = Bond(self._payment_dates, self._payment_steps, self._coupon_rates, self._frequency)
+        return callable_bond._bond, np.asarray(self._exercise_steps), callable_bond._lsm_exercise, True
+
+    def _lsm_exercise(self, i, bond_price):
+        """
+        Helper function that returns the value of the call of the exercise
+        step i
+        """
+        return np.maximum(bond_price - self._call_price(i), 0)
+
+    def _portfolio_events(self, payoff=None):
+        """
+        Helper function that describes the callable bond to a Portfolio: the
+        time slice where its backward induction starts, its number of columns
+        (the underlying bond and the callable bond) and the events applied to
+        those columns
+        """
+        callable_bond = copy.copy(self)
+        callable_bond._bond = Bond(self._payment_dates, self._payment_steps, self._coupon_rates, self._frequency)
+        callable_bond._bond_events = callable_bond._bond._portfolio_events()[2]
+        events = dict.fromkeys(callable_bond._bond_events, callable_bond._portfolio_event)
+        steps = self._exercise_steps.tolist() + self._payment_steps.tolist() + [self._steps + 1]
+        events.update(dict.fromkeys([i for i in steps if i <= self._steps + 1], callable_bond._portfolio_event))
+        return callable_bond._bond._steps, 2, events
+
+    def _portfolio_event(self, i, values):
+        """
+        Helper function that applies the bond events and the events of the
+        callable bond
+        """
+        if i in self._bond_events:
+            values[:, :1] = self._bond_events[i](i, values[:, :1])
+        if i == self._steps + 1:
+            values[:, 1:] = values[:, :1]
+        elif i <= self._steps:
+            values[:, 1:] = self._event(i, values[:, 1:])
+        return values
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Richardson extrapolation of tree prices and automatic step selection
+"""
+
+import time
+import numpy as np
+
+
+class ExtrapolatedPricer(object):
+    """
+    Richardson extrapolation of tree prices. The price is computed with two or
+    three numbers of steps and the leading error terms c1/N, c2/N^2, ... are
+    removed. The odd-even mode averages the prices of N and N + 1 steps first,
+    which cancels most of the oscillation of the trinomial tree prices.
+    The extrapolation assumes the error is a smooth power series in 1/N, which
+    only holds for smooth payoffs (bonds, swaps). The error of a kinked payoff
+    (an option struck between the nodes, an exercise decision) depends on
+    where the strike falls between the nodes, and the extrapolation can make
+    it worse, so for those products set smooth to False: the price is then
+    the one of the largest number of steps
+
+    """
+
+    def __init__(self, price_function, odd_even=True, smooth=True):
+        """
+        Initialize an ExtrapolatedPricer object
+
+        Parameters
+        ----------
+            price_function : callable with signature f(steps) that builds a
+                HWTree with the given number of steps, the products on it and
+                returns the price (a float or an ndarray, e.g. the prices of a
+                Portfolio)
+            odd_even : boolean, if True the prices of N and N + 1 steps are
+                averaged before the extrapolation, default value is True
+            smooth : boolean, if True the prices are extrapolated, otherwise
+                the price of the largest number of steps is used, default
+                value is True
+
+        """
+        self._price_function = price_function
+        self._odd_even = odd_even
+        self._smooth = smooth
+        self._prices = {}
+        self._times = {}
+
+    def _price(self, steps):
+        """
+        Helper function that returns the price of the given number of steps,
+        the price of every number of steps is computed once
+        """
+        steps = int(steps)
+        if steps not in self._prices:
+            start = time.perf_counter()
+            self._prices[steps] = np.asarray(self._price_function(steps), dtype=float)
+            self._times[steps] = time.perf_counter() - start
+        return self._prices[steps]
+
+    def _level_price(self, steps):
+        """
+        Helper function that returns the price of one level of the
+        extrapolation
+        """
+        if self._odd_even:
+            return 0.5*(self._price(steps) + self._price(steps + 1))
+        return self._price(steps)
+
+    def _combine(self, steps, prices):
+        """
+        Helper function that returns the extrapolated price, or the price of
+        the largest number of steps for a kinked payoff
+        """
+        if self._smooth:
+            return self.extrapolate(steps, prices)
+        return np.asarray(prices[-1], dtype=float)
+
+    @staticmethod
+    def extrapolate(steps, prices):
+        """
+        Returns the Richardson extrapolation of the prices computed with the
+        given numbers of steps, the error of the price of N steps is assumed to
+        be c1/N + ... + c{K-1}/N^(K-1) for K numbers of steps
+
+        Parameters
+        ----------
+            steps : array_like of shape (K, ) with the numbers of steps
+            prices : array_like of shape (K, ) or (K, M) with the prices
+
+        Return
+        ------
+            out: float or ndarray of shape (M, ) with the extrapolated price
+
+        """
+        steps = np.asarray(steps, dtype=float)
+        powers = (1/steps[:, None])**np.arange(len(steps))
+        weights = np.linalg.solve(powers.T, np.eye(len(steps))[0])
+        return np.tensordot(weights, np.asarray(prices, dtype=float), axes=1)
+
+    def price(self, steps=(100, 200, 400)):
+        """
+        This function computes the extrapolated price
+
+        Parameters
+        ----------
+            steps : array_like of shape (2, ) or (3, ) with the numbers of steps,
+                default value is (100, 200, 400)
+
+        Return
+        ------
+            out: dictionary with the extrapolated price, the prices of every
+                number of steps, the numbers of steps and the wall time used
+
+        """
+        start = time.perf_counter()
+        prices = [self._level_price(n) for n in steps]
+        return self._report(self._combine(steps, prices), steps, prices, start)
+
+    def auto_steps(self, tolerance, initial_steps=50, growth=2, levels=2, max_steps=6400):
+        """
+        This function increases the number of steps until the extrapolated
+        price changes less than the tolerance
+
+        Parameters
+        ----------
+            tolerance : price tolerance (a positive float), for several prices
+                it applies to the largest change
+            initial_steps : smallest number of steps, default value is 50
+            growth : factor between consecutive numbers of steps, default
+                value is 2
+            levels : number of step counts used by every extrapolation (2 or
+                3), default value is 2
+            max_steps : largest number of steps, default value is 6400
+
+        Return
+        ------
+            out: dictionary with the extrapolated price, the prices of every
+                number of steps, the numbers of steps, the wall time used, the
+                change of the last extrapolation and whether it converged
+
+        """
+        start = time.perf_counter()
+        steps = [int(initial_steps)]
+        prices = [self._level_price(steps[0])]
+        price = None
+        change = np.inf
+        while True:
+            next_steps = int(np.ceil(steps[-1]*growth))
+            if next_steps > max_steps:
+                break
+            steps.append(next_steps)
+            prices.append(self._level_price(next_steps))
+            if len(steps) < levels:
+                continue
+            previous = price
+            price = self._combine(steps[-levels:], prices[-levels:])
+            if previous is not None:
+                change = np.max(np.abs(price - previous))
+                if change < tolerance:
+                    break
+
+        if price is None:
+            price = prices[-1]
+        return self._report(price, steps, prices, start, change, tolerance)
+
+    def _report(self, price, steps, prices, start, change=None, tolerance=None):
+        """
+        Helper function that builds the report of a pricing
+        """
+        used = sorted(n for n in self._prices if n in steps or (self._odd_even and n - 1 in steps))
+        report = {'price': price,
+                  'steps': list(steps),
+                  'prices': dict(zip(steps, prices)),
+                  'tree_steps': used,
+                  'wall_time': time.perf_counter() - start,
+                  'tree_time': sum(self._times[n] for n in used)}
+        if tolerance is not None:
+            report['change'] = change
+            report['converged'] = bool(change < tolerance)
+        return report
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Theta scheme finite difference solver of the Hull-White PDE
+"""
+
+import numpy as np
+from scipy.linalg.lapack import dgttrf, dgttrs
+from simple_portfolio import Portfolio
+
+
+class HWFiniteDifference(object):
+    """
+    Finite difference solver of the Hull-White PDE. The short rate is
+    r = x + phi(t), the PDE of x, V_t - a*x*V_x + sigma^2/2*V_xx - x*V = 0, is
+    solved on a fixed uniform grid of x with a theta scheme (Crank-Nicolson
+    for theta = 1/2) and one tridiagonal solve per time step, and phi is
+    constant over every time step and calibrated to the ZCB prices with the
+    Arrow-Debreu prices of the discrete scheme, as the alphas of HWTree.
+    The time slices are the ones of HWTree (uniform or a time grid), so the
+    products are priced with the same payment and exercise steps.
+
+    Crank-Nicolson does not damp the kinks of the payoffs and the exercise
+    decisions, so the time steps that follow the start of the backward
+    induction and every event of the products are replaced by fully
+    implicit half steps (Rannacher time stepping). phi is calibrated with
+    the same steps, so the ZCB prices are still exact
+
+    """
+
+    def __init__(self, zcb_prices, zcb_maturities, maturity, steps, a, sigma, time_grid=None,
+                 nodes=201, width=5.0, theta=0.5, rannacher=2):
+        """
+        Initialize a HWFiniteDifference object
+
+        Parameters
+        ----------
+            zcb_prices : array_like of shape (M, ) with the ZCB prices
+            zcb_maturities: array_like of shape (M, ) with the ZCB maturities
+            maturity : longest maturity in the term structure (a positive float)
+            steps : number of time steps (a positive integer)
+            a : Hull-White parameter (a positive float)
+            sigma : Hull-White parameter (a positive float)
+            time_grid : array_like of shape (N + 1, ) with the times of the
+                time slices, see HWTree
+            nodes : number of nodes of the grid of x (an odd integer), default
+                value is 201
+            width : half width of the grid in standard deviations of x at the
+                maturity, default value is 5
+            theta : weight of the implicit part of the scheme, default value is
+                1/2 (Crank-Nicolson)
+            rannacher : number of fully implicit half steps after every event
+                (an even integer), default value is 2, no damping for 0
+
+        """
+        self._zcb_prices = zcb_prices
+        self._zcb_maturities = zcb_maturities
+        self._time_grid = time_grid
+        if time_grid is not None:
+            time_grid = np.asarray(time_grid, dtype=float)
+            maturity = time_grid[-1]
+            steps = len(time_grid) - 1
+        self._time = maturity
+        self._steps = steps
+        self._a = a
+        self._sigma = sigma
+        self._nodes = nodes + 1 - nodes % 2
+        self._width = width
+        self._theta = theta
+        self._rannacher = rannacher
+
+        self._times = None
+        self._dts = None
+        self._x = None
+        self._bands = None
+        self._factors = {}
+        self._phis = None
+        self._damped_steps = frozenset()
+        self._is_built = False
+
+    def update_parameters(self):
+        """
+        Helper function that computes the time slices, the grid of x and the
+        tridiagonal matrix of the operator -a*x*d/dx + sigma^2/2*d2/dx2 - x
+        """
+        if self._time_grid is None:
+            self._times = np.arange(self._steps + 1)*self._time/self._steps
+        else:
+            self._times = np.asarray(self._time_grid, dtype=float)
+        self._dts = np.diff(self._times)
+
+        a, sigma = self._a, self._sigma
+        variance = sigma**2*self._time if a*self._time < 1.e-8 else \
+            sigma**2*(1 - np.exp(-2*a*self._time))/(2*a)
+        half_nodes = self._nodes//2
+        dx = self._width*np.sqrt(variance)/half_nodes
+        x = np.arange(-half_nodes, half_nodes + 1)*dx
+        self._x = x
+
+        # central differences inside the grid, at the edges the second
+        # derivative is dropped and the first derivative is taken inwards
+        diffusion = 0.5*sigma**2/dx**2
+        lower = diffusion + 0.5*a*x/dx
+        diagonal = -2*diffusion - x
+        upper = diffusion - 0.5*a*x/dx
+        lower[-1], diagonal[-1], upper[-1] = a*x[-1]/dx, -a*x[-1]/dx - x[-1], 0
+        lower[0], diagonal[0], upper[0] = 0, a*x[0]/dx - x[0], -a*x[0]/dx
+        self._bands = (lower[1:], diagonal, upper[:-1])
+
+    def _zcb_grid_prices(self):
+        """
+        Helper function that returns the ZCB prices of the time slices, on a
+        non-uniform grid the log prices are linearly interpolated
+        """
+        if self._time_grid is None:
+            return np.asarray(self._zcb_prices, dtype=float)
+        maturities = np.asarray(self._zcb_maturities, dtype=float)
+        prices = np.asarray(self._zcb_prices, dtype=float)
+        return np.exp(np.interp(self._times, maturities, np.log(prices)))
+
+    def _factor(self, i, damped=False):
+        """
+        Helper function that returns the explicit part and the LU factorization
+        of the implicit part of the time step i, they are computed once for
+        every length of the time steps. A damped time step is made of two
+        fully implicit half steps, it has no explicit part
+        """
+        dt = self._dts[i]
+        factor = self._factors.get((dt, damped))
+        if factor is None:
+            lower, diagonal, upper = self._bands
+            if damped:
+                explicit = None
+                implicit = dgttrf(-0.5*dt*lower, 1 - 0.5*dt*diagonal, -0.5*dt*upper)[:5]
+            else:
+                explicit = ((1 - self._theta)*dt*lower, 1 + (1 - self._theta)*dt*diagonal,
+                            (1 - self._theta)*dt*upper)
+                implicit = dgttrf(-self._theta*dt*lower, 1 - self._theta*dt*diagonal,
+                                  -self._theta*dt*upper)[:5]
+            factor = (explicit, implicit)
+            self._factors[(dt, damped)] = factor
+        return factor
+
+    @staticmethod
+    def _multiply(bands, values, transpose=False):
+        """
+        Helper function that multiplies a tridiagonal matrix (or its transpose)
+        by the columns of values
+        """
+        lower, diagonal, upper = bands
+        if transpose:
+            lower, upper = upper, lower
+        out = diagonal[:, None]*values
+        out[1:] += lower[:, None]*values[:-1]
+        out[:-1] += upper[:, None]*values[1:]
+        return out
+
+    def _step(self, i, values, transpose=False):
+        """
+        Helper function that applies the scheme of the time step i without the
+        discounting with phi: (I - theta*dt*A)^-1 (I + (1 - theta)*dt*A) values,
+        or (I - dt/2*A)^-2 values on a damped time step, or its transpose
+        """
+        damped = i in self._damped_steps
+        explicit, implicit = self._factor(i, damped)
+        if damped:
+            trans = 'T' if transpose else 'N'
+            solution = dgttrs(*implicit, values, trans=trans)[0]
+            return dgttrs(*implicit, solution, trans=trans)[0]
+        if transpose:
+            solution = dgttrs(*implicit, values, trans='T')[0]
+            return self._multiply(explicit, solution, transpose=True)
+        return dgttrs(*implicit, self._multiply(explicit, values))[0]
+
+    def damped_steps(self, event_steps):
+        """
+        Returns the time steps that are damped for the given event time
+        slices: the rannacher/2 time steps before every one of them
+
+        Parameters
+        ----------
+            event_steps : iterable with the integer time slices of the events
+
+        Return
+        ------
+            out: frozenset with the integer time steps
+
+        """
+        return frozenset(i - k for i in event_steps for k in range(1, self._rannacher//2 + 1)
+                         if 0 <= i - k < self._steps)
+
+    def calibrate(self, damped_steps=frozenset()):
+        """
+        Computes phi on every time step so that the scheme reprices the ZCB of
+        every time slice
+
+        Parameters
+        ----------
+            damped_steps : set with the time steps made of fully implicit half
+                steps, see damped_steps, by default none
+
+        Return
+        ------
+            out: ndarray of shape (N, ) with phi on every time step
+
+        """
+        self._is_built = True
+        self._damped_steps = frozenset(damped_steps)
+        self.update_parameters()
+        zcb_prices = self._zcb_grid_prices()
+        center = self._nodes//2
+
+        # the Arrow-Debreu prices start at x = 0 and they are moved forward
+        # with the transpose of the scheme
+        state_prices = np.zeros((self._nodes, 1))
+        state_prices[center] = 1
+        ones = np.ones((self._nodes, 1))
+        phis = np.zeros(self._steps)
+        for i in range(self._steps):
+            bond = np.dot(state_prices[:, 0], self._step(i, ones)[:, 0])
+            phis[i] = np.log(bond/zcb_prices[i + 1])/self._dts[i]
+            state_prices = self._step(i, state_prices, transpose=True)*np.exp(-phis[i]*self._dts[i])
+        self._phis = phis
+        return phis
+
+    def step_back(self, i, values):
+        """
+        Computes the discounted expected value at the time slice i of the given
+        values on the time slice i + 1
+
+        Parameters
+        ----------
+            i : integer time slice
+            values : ndarray of shape (N, K) with the values of the grid nodes
+
+        Return
+        ------
+            out: ndarray of shape (N, K)
+
+        """
+        return self._step(i, values)*np.exp(-self._phis[i]*self._dts[i])
+
+    def get_prices(self, portfolio):
+        """
+        This function computes the prices of all the products of a portfolio
+
+        Parameters
+        ----------
+            portfolio: a Portfolio class instance
+
+        Return
+        ------
+            out: ndarray of shape (N, ) with the price of every product
+
+        """
+        start, num_columns, columns, events = portfolio._layout()
+        # the scheme is damped after the payoffs and the exercise decisions,
+        # phi is calibrated again if they change the damped time steps
+        damped_steps = self.damped_steps([i for i in events if i <= start])
+        if not self._is_built or damped_steps != self._damped_steps:
+            self.calibrate(damped_steps)
+
+        # the product events act on the nodes one by one, so they are the same
+        # on the grid as on the tree
+        values = np.zeros((self._nodes, num_columns))
+        values = portfolio._apply_events(start, values, events)
+        for i in reversed(range(start)):
+            values = self.step_back(i, values)
+            values = portfolio._apply_events(i, values, events)
+
+        return values[self._nodes//2, columns]
+
+    def get_price(self, instrument, payoff=None):
+        """
+        This function computes the price of a product
+
+        Parameters
+        ----------
+            instrument: a ZCBond, Bond, SimpleDerivative, SimpleSwaption or
+                CallableBond class instance
+            payoff: a PayOff class instance, only for SimpleDerivative and
+                SimpleSwaption
+
+        Return
+        ------
+            out: float scalar with the price
+
+        """
+        portfolio = Portfolio()
+        portfolio.add(instrument, payoff)
+        return self.get_prices(portfolio)[0]
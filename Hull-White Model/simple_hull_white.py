@@ -4,19 +4,271 @@ Created on Thu Nov  2 16:43:32 2017
 
 @author: Jesus
 """
+from collections.abc import Mapping
 import numpy as np
 
+
+class LatticeView(Mapping):
+    """
+    Read-only view of a lattice stored as a dense array, keyed by (i, j)
+    tuples as the old dictionary trees were
+
+    """
+
+    def __init__(self, values, half_widths, offset):
+        """
+        Initialize a LatticeView object
+
+        Parameters
+        ----------
+            values : ndarray of shape (N, W) with one row per time slice
+            half_widths : array_like of shape (N, ) with the largest state j
+                of every time slice
+            offset : integer column of the state j = 0
+
+        """
+        self._values = values
+        self._half_widths = half_widths
+        self._offset = offset
+
+    def __getitem__(self, key):
+        i, j = key
+        if i < 0 or i >= len(self._half_widths) or abs(j) > self._half_widths[i]:
+            raise KeyError(key)
+        return self._values[i, j + self._offset]
+
+    def __iter__(self):
+        for i, half_width in enumerate(self._half_widths):
+            for j in range(-half_width, half_width + 1):
+                yield (i, j)
+
+    def __len__(self):
+        return int(np.sum(2*np.asarray(self._half_widths) + 1))
+
+    def slice(self, i):
+        """
+        Returns the values of the states -j, ..., j of the time slice i
+        """
+        half_width = self._half_widths[i]
+        return self._values[i, self._offset - half_width:self._offset + half_width + 1]
+
+
+def event_time_grid(event_times, fine_dt, coarse_dt, growth=1.5, points=1001):
+    """
+    Builds a non-uniform time grid that has a node at every event time (payment,
+    reset or exercise times). The steps are fine_dt long next to the events and
+    grow geometrically by the factor growth, up to coarse_dt, away from them.
+
+    Parameters
+    ----------
+        event_times : array_like of shape (M, ) with the event times in years,
+            the largest one is the maturity of the grid
+        fine_dt : step length next to the events in years
+        coarse_dt : largest step length in years
+        growth : factor that limits the growth of consecutive steps, default
+            value is 1.5
+        points : number of points used to integrate the step density between
+            two consecutive events, default value is 1001
+
+    Return
+    ------
+        out: ndarray of shape (N + 1, ) with the times of the grid, the first
+            time is 0
+
+    """
+    events = np.unique(np.append(np.asarray(event_times, dtype=float), 0.0))
+    grid = [events[:1]]
+    for start, end in zip(events[:-1], events[1:]):
+        # the number of steps is the integral of the inverse of the desired step
+        # length, the nodes split that integral into equal pieces
+        t = np.linspace(start, end, points)
+        dt = np.minimum(coarse_dt, fine_dt + (growth - 1)*np.minimum(t - start, end - t))
+        density = np.concatenate(([0.0], np.cumsum(0.5*(1/dt[1:] + 1/dt[:-1])*np.diff(t))))
+        steps = max(1, int(np.ceil(density[-1] - 1.e-9)))
+        nodes = np.interp(np.linspace(0, density[-1], steps + 1), density, t)
+        nodes[-1] = end
+        grid.append(nodes[1:])
+    return np.concatenate(grid)
+
+
+class TransitionOperator(object):
+    """
+    Branching probabilities of one time step of a Hull-White tree, stored as a
+    banded operator: three probability bands (down, middle, up) and the central
+    state each state branches to. Normal branching rows have the state itself
+    as central state and the edge rows at -jmax and jmax have it shifted one
+    state inwards, so both regions are applied by the same array operation.
+
+    """
+
+    def __init__(self, a, dt, ratio, next_half_width, half_width):
+        """
+        Initialize a TransitionOperator object
+
+        Parameters
+        ----------
+            a : Hull-White parameter (a positive float)
+            dt : length of the time step in years
+            ratio : state spacing of the time slice over the state spacing of
+                the next time slice (1 on a uniform grid)
+            next_half_width : largest state j of the next time slice
+            half_width : largest state j the operator is computed for
+
+        """
+        self._half_width = half_width
+        j = np.arange(-half_width, half_width + 1)
+
+        # the central state of the branching is the closest state to the
+        # expected value, so far as it is inside the next time slice. On a
+        # uniform grid, this is normal branching for |j| < jmax and upwards or
+        # downwards branching at -jmax and jmax
+        self._centres = np.clip(np.round(j*ratio*(1 - a*dt)), 1 - next_half_width,
+                                next_half_width - 1).astype(int)
+        eta = (j*ratio - self._centres) - j*ratio*a*dt
+        eta2 = eta**2
+
+        # derivative of eta with respect to a for a fixed branching, it is
+        # needed by the adjoint sensitivities (see simple_adjoint)
+        self._eta = eta
+        self._eta_a = -j*ratio*dt
+
+        up = 1/6 + 0.5*(eta2 + eta)
+        middle = 2/3 - eta2
+        down = 1/6 + 0.5*(eta2 - eta)
+
+        # the row d of _probs holds the probability of moving from the state j
+        # to the state _centres[j] + d - 1
+        self._probs = np.vstack((down, middle, up))
+
+    def _window(self, half_width):
+        """
+        Helper function that selects the states -half_width, ..., half_width
+        """
+        return slice(self._half_width - half_width, self._half_width + half_width + 1)
+
+    def prob(self, k, j):
+        """
+        Returns the probability of going from state k to state j
+        """
+        d = j - self._centres[k + self._half_width]
+        if abs(d) > 1:
+            return 0
+        return self._probs[d + 1, k + self._half_width]
+
+    def prob_derivative(self, half_width):
+        """
+        Returns the derivatives of the down, middle and up probabilities of the
+        states -half_width, ..., half_width with respect to a, the central
+        states of the branching are kept fixed
+        """
+        window = self._window(half_width)
+        eta = self._eta[window]
+        return np.vstack((eta - 0.5, -2*eta, eta + 0.5))*self._eta_a[window]
+
+    def forward(self, weights, next_half_width):
+        """
+        Spreads the weights of a time slice over the next time slice
+
+        Parameters
+        ----------
+            weights : ndarray of shape (2*N + 1, ) or (2*N + 1, K) with the
+                values of the states -N, ..., N, the K columns are spread
+                together
+            next_half_width : largest state j of the next time slice
+
+        Return
+        ------
+            out: ndarray of shape (2*next_half_width + 1, ) or
+                (2*next_half_width + 1, K)
+
+        """
+        window = self._window((len(weights) - 1)//2)
+        targets = self._centres[window] + np.arange(-1, 2)[:, None] + next_half_width
+        if np.ndim(weights) == 1:
+            values = self._probs[:, window]*weights
+            return np.bincount(targets.ravel(), weights=values.ravel(),
+                               minlength=2*next_half_width + 1)
+
+        # every column is spread over its own block of bins
+        columns = weights.shape[1]
+        values = self._probs[:, window, None]*weights
+        targets = targets[:, :, None]*columns + np.arange(columns)
+        out = np.bincount(targets.ravel(), weights=values.ravel(),
+                          minlength=(2*next_half_width + 1)*columns)
+        return out.reshape(-1, columns)
+
+    def backward(self, values, half_width):
+        """
+        Computes the expected value at every state of a time slice of the
+        given values on the next time slice
+
+        Parameters
+        ----------
+            values : ndarray of shape (2*M + 1, ) or (2*M + 1, K) with the values
+                of the states -M, ..., M of the next time slice
+            half_width : largest state j of the time slice
+
+        Return
+        ------
+            out: ndarray of shape (2*half_width + 1, ) or (2*half_width + 1, K)
+
+        """
+        window = self._window(half_width)
+        columns = self._centres[window] + (len(values) - 1)//2
+        probs = self._probs[:, window].reshape((3, -1) + (1,)*(np.ndim(values) - 1))
+        return probs[0]*values[columns - 1] + probs[1]*values[columns] + probs[2]*values[columns + 1]
+
+
+# transition operators shared by all the trees, keyed by (a, dt, ratio, jmax)
+MAX_CACHED_OPERATORS = 1024
+_operators = {}
+
+
+def transition_operator(a, dt, ratio, jmax, half_width):
+    """
+    Returns the cached transition operator of a time step, it is computed only
+    if no tree has needed it before (or if it was computed for fewer states)
+
+    Parameters
+    ----------
+        a : Hull-White parameter (a positive float)
+        dt : length of the time step in years
+        ratio : state spacing of the time slice over the state spacing of the
+            next time slice
+        jmax : largest central state of the branching is jmax - 1
+        half_width : largest state j the operator is needed for
+
+    Return
+    ------
+        out: a TransitionOperator class instance
+
+    """
+    key = (a, dt, ratio, jmax)
+    operator = _operators.get(key)
+    if operator is None or operator._half_width < half_width:
+        if operator is None and len(_operators) >= MAX_CACHED_OPERATORS:
+            del _operators[next(iter(_operators))]
+        # a growing tree asks for one more state at every time step, so the
+        # operator grows geometrically up to jmax
+        if operator is not None:
+            half_width = max(half_width, min(2*operator._half_width, jmax))
+        operator = TransitionOperator(a, dt, ratio, jmax, half_width)
+        _operators[key] = operator
+    return operator
+
+
 class HWTree(object):
     """
     Representation of a Hull-White Tree
-    
+
     """
-    
-    
-    def __init__(self, zcb_prices, zcb_maturities, maturity, steps, a, sigma):
+
+
+    def __init__(self, zcb_prices, zcb_maturities, maturity, steps, a, sigma, time_grid=None,
+                 sigma_times=None):
         """
         Initialize a Hull- White Tree object
-        
+
         Parameters
         ----------
             zcb_prices : array_like of shape (M, )
@@ -26,132 +278,464 @@ class HWTree(object):
             maturity : longest maturity in the term structure (a positive float)
             steps : number of steps in the three (an positive integer)
             a : Hull-White parameter (a positive float)
-            sigma : Hull-White parameter (a positive float)
-            
+            sigma : Hull-White parameter (a positive float), or array_like of
+                shape (K, ) with a piecewise constant volatility if sigma_times
+                is given
+            time_grid : array_like of shape (N + 1, ) with the increasing times
+                of the time slices starting at 0, optional. If it is given the
+                tree is built on this non-uniform grid (see event_time_grid),
+                maturity and steps are taken from the grid and the ZCB prices
+                are interpolated at the grid times. Otherwise the grid is
+                uniform and zcb_prices[i] is the ZCB price of the time slice i
+            sigma_times : array_like of shape (K, ) with the increasing times
+                where the pieces of sigma end, optional. sigma[k] is the
+                volatility up to sigma_times[k] and the last piece is extended
+                flat. The spacing of the states of every time slice follows
+                the variance of its time step (the adjoint sensitivities need
+                a constant sigma)
+
         """
         self._zcb_prices = zcb_prices
         self._zcb_maturities = zcb_maturities
+        self._time_grid = time_grid
+        if time_grid is not None:
+            time_grid = np.asarray(time_grid, dtype=float)
+            maturity = time_grid[-1]
+            steps = len(time_grid) - 1
         self._time = maturity
         self._steps = steps
-        
+
         # Tree parameters
         self._a = a
         self._sigma = sigma
+        self._sigma_times = sigma_times
         self._jmax = None
         self._dt = None
         self._dR_star = None
-        
-        # Trees
-        self._shor_rate_tree = {}
-        self._state_price_tree = {}
-        self._discount_factor_tree = {}
-                
-        # Probabilities
-        self._hw_prob = {}        
-        
+        self._times = None
+        self._dts = None
+        self._dxs = None
+
+        # Trees, stored as dense arrays with one row per time slice and one
+        # column per state, the state j = 0 lies in the column _offset and the
+        # states beyond jmax are never built
+        self._offset = None
+        self._half_widths = None
+        self._num_nodes = None
+        self._num_full_nodes = None
+        self._rates = None
+        self._state_prices = None
+        self._discount_factors = None
+        self._alphas = None
+
+        # Number of calibrated time slices, the tree is calibrated lazily up to
+        # the deepest time slice a product has asked for (see calibrate_to)
+        self._calibrated_steps = 0
+
+        # Probabilities, one transition operator per time step
+        self._operators = None
+
         # Boolean
         self._is_built = False
-        
+
+    @property
+    def _shor_rate_tree(self):
+        return LatticeView(self._rates, self._half_widths[:self._calibrated_steps], self._offset)
+
+    @property
+    def _state_price_tree(self):
+        return LatticeView(self._state_prices, self._half_widths[:self._calibrated_steps], self._offset)
+
+    @property
+    def _discount_factor_tree(self):
+        return LatticeView(self._discount_factors, self._half_widths[:self._calibrated_steps], self._offset)
+
+    def half_width(self, i):
+        """
+        Helper function that returns the largest state j of the time slice i,
+        the tree stops growing once it reaches jmax
+        """
+        return self._half_widths[i]
+
+    def node_saving(self):
+        """
+        Returns the number of nodes of the tree, the number of nodes the tree
+        would have without the jmax truncation and the fraction of nodes saved.
+        The branching is computed if the tree has not been calibrated yet
+        """
+        if self._operators is None:
+            self.hw_prob()
+        self._count_nodes()
+        return self._num_nodes, self._num_full_nodes, 1 - self._num_nodes/self._num_full_nodes
+
+    def time_steps(self, times):
+        """
+        Returns the time slices closest to the given times
+
+        Parameters
+        ----------
+            times : array_like of shape (M, ) with times in years
+
+        Return
+        ------
+            out: ndarray of shape (M, ) with integer time slices
+
+        """
+        if self._times is None:
+            self.update_parameters()
+        times = np.asarray(times, dtype=float)
+        index = np.clip(np.searchsorted(self._times, times), 1, self._steps)
+        closer = times - self._times[index - 1] < self._times[index] - times
+        return index - closer
+
     def update_parameters(self):
         """
         Helper function that updated internal parameters
         """
         self._jmax = np.ceil(0.184 / (self._a*self._time/self._steps)).astype(int)
         self._dt = self._time/self._steps
-        self._dR_star = np.sqrt(3*self._sigma**2*self._time/self._steps)
-        
+        if self._sigma_times is None:
+            self._dR_star = np.sqrt(3*self._sigma**2*self._time/self._steps)
+
+        # the time step i goes from the time slice i to the time slice i + 1
+        # and sets the spacing of the states of the time slice i + 1
+        if self._time_grid is None:
+            self._times = np.arange(self._steps + 1)*self._dt
+            self._dts = np.full(self._steps, self._dt)
+        else:
+            self._times = np.asarray(self._time_grid, dtype=float)
+            self._dts = np.diff(self._times)
+        self._dxs = self._state_spacings()
+
+    def _state_spacings(self):
+        """
+        Helper function that returns the spacing of the states of every time
+        slice, sqrt(3*V) with V the variance of sigma*dW over the time step
+        that ends at the time slice (the first time step for the time slice 0)
+        """
+        if self._sigma_times is None:
+            if self._time_grid is None:
+                return np.full(self._steps + 1, self._dR_star)
+            return np.sqrt(3*self._sigma**2*np.append(self._dts[:1], self._dts))
+
+        # the integral of sigma^2 is piecewise linear in time
+        sigmas = np.asarray(self._sigma, dtype=float)
+        knots = np.append(0, self._sigma_times)[:len(sigmas)]
+        integrals = np.append(0, np.cumsum(sigmas[:-1]**2*np.diff(knots)))
+        piece = np.searchsorted(knots, self._times, side='right') - 1
+        variances = np.diff(integrals[piece] + sigmas[piece]**2*(self._times - knots[piece]))
+        return np.sqrt(3*np.append(variances[:1], variances))
+
+    def _zcb_grid_prices(self):
+        """
+        Helper function that returns the ZCB prices of the time slices, on a
+        non-uniform grid the log prices are linearly interpolated
+        """
+        if self._time_grid is None:
+            return np.asarray(self._zcb_prices, dtype=float)
+        maturities = np.asarray(self._zcb_maturities, dtype=float)
+        prices = np.asarray(self._zcb_prices, dtype=float)
+        return np.exp(np.interp(self._times, maturities, np.log(prices)))
+
     def hw_prob(self):
         """
         Compute the up, middle and down probabilities for all the states
         """
         self.update_parameters()
-        
-        a2 = self._a**2
-        dt2 = self._dt**2
-        for j in range(-self._steps - 1, self._steps + 2): # I added one more state
-            j2 = j**2
-            if j > -self._jmax and j < self._jmax:                
-                self._hw_prob[1, j] = 1/6 + 0.5*(a2*j2*dt2 - self._a*j*self._dt)
-                self._hw_prob[0, j] = 2/3 - a2*j2*dt2
-                self._hw_prob[-1, j] = 1/6 + 0.5*(a2*j2*dt2 + self._a*j*self._dt)                
-            elif j <= -self._jmax:
-                self._hw_prob[1, j] = 1/6 + 0.5*(a2*j2*dt2 + self._a*j*self._dt)
-                self._hw_prob[0, j] = -1/3 - a2*j2*dt2 - 2*self._a*j*self._dt
-                self._hw_prob[-1, j] = 7/6 + 0.5*(a2*j2*dt2 + 3*self._a*j*self._dt)
-            else:
-                self._hw_prob[1, j] = 7/6 + 0.5*(a2*j2*dt2 - 3*self._a*j*self._dt)
-                self._hw_prob[0, j] = -1/3 - a2*j2*dt2 + 2*self._a*j*self._dt
-                self._hw_prob[-1, j] = 1/6 + 0.5*(a2*j2*dt2 - self._a*j*self._dt)
-    
-    def prob(self, k, j):
+
+        self._operators = []
+        self._half_widths = np.zeros(1, dtype=int)
+        self._branching(0)
+
+    def _branching(self, start):
         """
-        Helper function that computes the probabilities of going from state k 
-        to state j in consecutive time steps
+        Helper function that sets the transition operators and the width of the
+        time slices from the time step start onward
         """
-        if k > -self._jmax and k < self._jmax:
-            if j - k == -2 or j - k == 2:
-                return 0
-            else:
-                return self._hw_prob[j - k, k]
-        elif k <= -self._jmax:
-            if j - k < 0:
-                return 0
-            else:
-                return self._hw_prob[j - k - 1, k]
-        else:
-            if j - k > 0:
-                return 0
-            else:
-                return self._hw_prob[j - k + 1, k]
+        operators = self._operators[:start]
+        half_widths = self._half_widths[:start + 1].tolist()
+        for i in range(start, self._steps):
+            dt = self._dts[i]
+            ratio = self._dxs[i]/self._dxs[i + 1]
+
+            # the tree is truncated at jmax for this time step, but it keeps
+            # enough states for the largest state to branch with positive
+            # probabilities
+            jmax = int(np.ceil(0.184/(self._a*dt)))
+            largest = half_widths[i]*ratio*(1 - self._a*dt)
+            next_half_width = int(min(np.round(largest) + 1, max(jmax, np.ceil(largest + 0.184 - 1.e-9))))
+
+            # while the tree grows no state is truncated, so every time step
+            # with the same dt shares the operator of the full width tree
+            operator = transition_operator(self._a, dt, ratio, max(jmax, next_half_width), half_widths[i])
+            operators.append(operator)
+            half_widths.append(next_half_width)
+
+        # the lists are rebuilt rather than extended because a calibrated tree
+        # may share them with other trees through the tree cache
+        self._operators = operators
+        self._half_widths = np.array(half_widths)
+        self._offset = int(self._half_widths.max())
+
+    def prob(self, k, j, i=None):
+        """
+        Helper function that computes the probabilities of going from state k
+        to state j in consecutive time steps. The time slice i of the state k
+        is only needed on a non-uniform grid, by default it is the last time
+        step
+        """
+        if i is None:
+            i = self._steps - 1
+        return self._operators[i].prob(k, j)
+
+    def _backward_induction(self, i, values):
+        """
+        Helper function that computes the expected value at every state of the
+        time slice i of the given values on the time slice i + 1
+
+        Parameters
+        ----------
+            i : integer time slice
+            values : ndarray of shape (N, ) or (N, K) with the values of the
+                states of the time slice i + 1
+
+        Return
+        ------
+            out: ndarray with the expected values of the time slice i
 
-    def calibrate(self):
+        """
+        return self._operators[i].backward(values, self.half_width(i))
+
+    def calibrate(self, steps=None):
         """
         Builds a tree for the short rate, the discount factors and the Arrow-
         Debreu prices
+
+        Parameters
+        ----------
+            steps : number of time slices to calibrate, by default all of them.
+                The remaining time slices are calibrated on demand by
+                calibrate_to
+
+        Return
+        ------
+            out: ndarray with the alphas of the calibrated time slices
+
         """
         self._is_built = True
-        
-        # Initialize the array of alphas
-        alphas = np.zeros(shape=self._steps)
-        alphas[0] = -np.log(self._zcb_prices[1])/self._dt
-        
-        # Initialize the Arrow-Debreu tree
-        self._state_price_tree[0, 0] = 1
-        
-        # Initialize the short rate tree
-        self._shor_rate_tree[0, 0] = alphas[0]
-        
-        # Initialize the discount factor tree
-        self._discount_factor_tree[0, 0] = np.exp(-alphas[0]*self._dt)
-        
-        # Build discount factors array for R*
-        discount_factors = {}
-        
-        for j in range(-self._steps, self._steps + 1):
-            discount_factors[j] = np.exp(-j*self._dR_star*self._dt)
-        
-        # Calibrate the trees
-        for i in range(1, self._steps):
-            
+        if self._operators is None:
+            self.hw_prob()
+        if steps is None:
+            steps = self._steps
+
+        # Allocate the trees, the time slice i holds the states -min(i, jmax),
+        # ..., min(i, jmax)
+        self._state_prices = None
+        self._rates = None
+        self._discount_factors = None
+        self._alphas = None
+        self._calibrated_steps = 0
+        self._allocate(0, min(max(steps, 1), self._steps))
+
+        # Calibrate the trees one time slice at a time
+        return self._calibrate_steps(0, len(self._alphas))
+
+    def calibrate_to(self, steps):
+        """
+        Makes sure the time slices 0, ..., steps - 1 are calibrated, the new
+        time slices extend the current trees
+
+        Parameters
+        ----------
+            steps : number of time slices a product needs
+
+        Return
+        ------
+            out: ndarray with the alphas of the calibrated time slices
+
+        """
+        if not self._is_built:
+            return self.calibrate(steps)
+        steps = min(steps, self._steps)
+        if steps <= self._calibrated_steps:
+            return self._alphas[:self._calibrated_steps]
+
+        # the trees are only reallocated when they are too short, and then
+        # their capacity at least doubles, so a sequence of deeper requests
+        # copies the trees a logarithmic number of times
+        start = self._calibrated_steps
+        if steps > len(self._alphas):
+            self._allocate(start, min(max(steps, 2*len(self._alphas)), self._steps))
+        return self._calibrate_steps(start, steps, state_prices=True)
+
+    def _count_nodes(self):
+        """
+        Helper function that counts the nodes of the tree with and without the
+        jmax truncation
+        """
+        steps = self._steps
+        self._num_nodes = int(np.sum(2*self._half_widths[:steps] + 1))
+        self._num_full_nodes = steps**2
+
+    def _allocate(self, rows, new_rows):
+        """
+        Helper function that allocates the trees for new_rows time slices and
+        copies the first rows of the current trees. The current arrays are
+        never modified because a calibrated tree may share them with other
+        trees through the tree cache
+        """
+        width = 2*self._offset + 1
+        self._count_nodes()
+
+        trees = []
+        for tree in (self._state_prices, self._rates, self._discount_factors):
+            new_tree = np.zeros(shape=(new_rows, width))
+            if rows > 0:
+                shift = self._offset - (tree.shape[1] - 1)//2
+                new_tree[:rows, shift:shift + tree.shape[1]] = tree[:rows]
+            trees.append(new_tree)
+        self._state_prices, self._rates, self._discount_factors = trees
+
+        alphas = np.zeros(shape=new_rows)
+        if rows > 0:
+            alphas[:rows] = self._alphas[:rows]
+        self._alphas = alphas
+
+    def _calibrate_steps(self, start, end, state_prices=False):
+        """
+        Helper function that computes the alphas, the short rates and the
+        discount factors of the time slices start, ..., end - 1, and the Arrow-
+        Debreu prices after the time slice start (or from the time slice start
+        if state_prices is True)
+        """
+        zcb_prices = self._zcb_grid_prices()
+        offset = self._offset
+        dts = self._dts
+        alphas = self._alphas
+
+        for i in range(start, end):
+            states = np.arange(-self.half_width(i), self.half_width(i) + 1)
+            current = states + offset
+
             # Update the Arrow-Debreu tree
-            for j in range(-i, i + 1):
-                value = 0
-                for k in range(j - 2, j + 3):                    
-                    if k < i and k > -i:
-                        value += self._state_price_tree[i - 1, k]*self.prob(k, j)*self._discount_factor_tree[i - 1, k]                        
-                    else:
-                        continue
-                    
-                self._state_price_tree[(i, j)] = value
-            
+            if i == 0:
+                self._state_prices[0, offset] = 1
+            elif i > start or state_prices:
+                previous_states = np.arange(-self.half_width(i - 1), self.half_width(i - 1) + 1)
+                previous = previous_states + offset
+                weights = self._state_prices[i - 1, previous]*self._discount_factors[i - 1, previous]
+                self._state_prices[i, current] = self._operators[i - 1].forward(weights, self.half_width(i))
+
             # Update the array of alphas
-            for j in range(-i, i + 1):
-                alphas[i] += self._state_price_tree[i, j]*discount_factors[j]
-            
-            alphas[i] = np.log(alphas[i]/self._zcb_prices[i + 1])/self._dt
-            
+            if i == 0:
+                alphas[0] = -np.log(zcb_prices[1])/dts[0]
+            else:
+                discount_factors = np.exp(-states*self._dxs[i]*dts[i])
+                alphas[i] = np.log(np.dot(self._state_prices[i, current], discount_factors)/zcb_prices[i + 1])/dts[i]
+
             # Update the short rate and discount factor trees
-            for j in range(-i, i + 1):  
-                self._shor_rate_tree[i, j] = alphas[i] + j*self._dR_star
-                self._discount_factor_tree[i, j] = np.exp(-self._shor_rate_tree[i, j]*self._dt)
-        return alphas
\ No newline at end of file
+            self._rates[i, current] = alphas[i] + states*self._dxs[i]
+            self._discount_factors[i, current] = np.exp(-self._rates[i, current]*dts[i])
+
+        self._calibrated_steps = max(self._calibrated_steps, end)
+        return alphas[:self._calibrated_steps]
+
+    def update_curve(self, zcb_prices, zcb_maturities=None):
+        """
+        Recalibrates the tree to a new term structure. Only the time steps from
+        the first time slice whose ZCB price has changed onward are computed
+        again, the earlier time slices are kept
+
+        Parameters
+        ----------
+            zcb_prices : array_like of shape (M, ) with the new ZCB prices
+            zcb_maturities: array_like of shape (M, ) with the new ZCB
+                maturities, by default the maturities do not change
+
+        Return
+        ------
+            out: ndarray with the alphas of the calibrated time slices
+
+        """
+        if not self._is_built:
+            self._zcb_prices = zcb_prices
+            if zcb_maturities is not None:
+                self._zcb_maturities = zcb_maturities
+            return self.calibrate()
+
+        old_prices = self._zcb_grid_prices()[:self._steps + 1]
+        self._zcb_prices = zcb_prices
+        if zcb_maturities is not None:
+            self._zcb_maturities = zcb_maturities
+        new_prices = self._zcb_grid_prices()[:self._steps + 1]
+
+        # the ZCB price of the time slice i + 1 sets alpha i, the Arrow-Debreu
+        # prices up to the time slice i do not depend on it
+        changed = np.flatnonzero(new_prices != old_prices)
+        end = self._calibrated_steps
+        if len(changed) == 0 or changed[0] - 1 >= end:
+            return self._alphas[:end]
+        start = max(changed[0] - 1, 0)
+        self._allocate(start + 1, len(self._alphas))
+        return self._calibrate_steps(start, end)
+
+    def extend(self, maturity=None, steps=None, zcb_prices=None, zcb_maturities=None,
+               time_grid=None):
+        """
+        Extends the horizon of the tree. The time slices of the current tree do
+        not change, so only the new time steps are calibrated (if the tree was
+        calibrated up to its horizon, otherwise they are calibrated on demand)
+
+        Parameters
+        ----------
+            maturity : new longest maturity of a uniform tree, the length of
+                the time steps can not change
+            steps : new number of steps of a uniform tree
+            zcb_prices : array_like of shape (M, ), ZCB prices that cover the
+                new horizon, by default the prices do not change
+            zcb_maturities: array_like of shape (M, ), ZCB maturities of the
+                new prices
+            time_grid : array_like of shape (N + 1, ), new time grid of a
+                non-uniform tree, it must start with the current grid
+
+        Return
+        ------
+            out: ndarray with the alphas of the calibrated time slices
+
+        """
+        old_steps = self._steps
+        if self._time_grid is None:
+            if not np.isclose(maturity/steps, self._time/self._steps, rtol=1.e-12, atol=0):
+                raise ValueError('the new maturity and steps must keep the length of the time steps')
+            self._time = maturity
+            self._steps = steps
+        else:
+            time_grid = np.asarray(time_grid, dtype=float)
+            if not np.array_equal(time_grid[:old_steps + 1], self._times):
+                raise ValueError('the new time grid must start with the current time grid')
+            self._time_grid = time_grid
+            self._time = time_grid[-1]
+            self._steps = len(time_grid) - 1
+        if self._steps < old_steps:
+            raise ValueError('the tree can only be extended')
+        if zcb_prices is not None:
+            self._zcb_prices = zcb_prices
+        if zcb_maturities is not None:
+            self._zcb_maturities = zcb_maturities
+
+        if self._operators is None:
+            return None
+        jmax, dt, dR_star = self._jmax, self._dt, self._dR_star
+        self.update_parameters()
+        if self._time_grid is None:
+            # keep the parameters of the uniform tree bit for bit
+            self._jmax, self._dt, self._dR_star = jmax, dt, dR_star
+            self._times = np.arange(self._steps + 1)*dt
+            self._dts = np.full(self._steps, dt)
+            self._dxs = self._state_spacings()
+        self._branching(old_steps)
+        if not self._is_built:
+            return None
+        if self._calibrated_steps < old_steps:
+            return self._alphas[:self._calibrated_steps]
+        return self.calibrate_to(self._steps)
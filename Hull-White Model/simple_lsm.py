@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Longstaff-Schwartz pricing of Bermudan swaptions and callable bonds
+"""
+
+import numpy as np
+from simple_monte_carlo import HWMonteCarlo
+
+
+class ExerciseRule(object):
+    """
+    Exercise rule of a Bermudan option on a bond, evaluated on the path
+    matrices of a HWMonteCarlo engine whose simulation times are the exercise
+    times. The continuation value of every exercise date is a regression on
+    the powers of the short rate and the exercise value
+
+    """
+
+    def __init__(self, payment_times, amounts, payment_steps, exercise_steps, exercise, degree=2):
+        """
+        Initialize an ExerciseRule object
+
+        Parameters
+        ----------
+            payment_times : ndarray of shape (M, ) with the payment times of
+                the bond in years
+            amounts : ndarray of shape (M, ) with the payments of the bond
+            payment_steps : ndarray of shape (M, ) with the payment steps
+            exercise_steps : ndarray of shape (E, ) with the exercise steps
+            exercise : callable with signature f(i, bond_price) that returns
+                the exercise value of the exercise step i
+            degree : degree of the polynomial in the short rate, default value
+                is 2
+
+        """
+        self._payment_times = payment_times
+        self._amounts = amounts
+        self._payment_steps = payment_steps
+        self._exercise_steps = exercise_steps
+        self._exercise = exercise
+        self._degree = degree
+        self._coefficients = None
+
+    def exercise_values(self, engine, rates):
+        """
+        Returns the exercise values of every path and exercise date, the
+        underlying bond is priced in closed form with the payments after the
+        exercise step
+
+        Parameters
+        ----------
+            engine : a HWMonteCarlo class instance
+            rates : ndarray of shape (N, E) with the short rates
+
+        Return
+        ------
+            out: ndarray of shape (N, E)
+
+        """
+        values = np.zeros(rates.shape)
+        for e, i in enumerate(self._exercise_steps):
+            remaining = self._payment_steps > i
+            bond_prices = engine.bond_price(e, self._payment_times[remaining], rates[:, e])
+            values[:, e] = self._exercise(i, np.dot(bond_prices, self._amounts[remaining]))
+        return values
+
+    def basis(self, rates, values):
+        """
+        Returns the regression basis 1, r, ..., r^degree and the exercise value
+        """
+        return np.column_stack([rates**p for p in range(self._degree + 1)] + [values])
+
+    def __call__(self, engine, rates, discount_factors):
+        """
+        Returns the discounted exercise value of every path, the option is
+        exercised at the first date where the exercise value is positive and
+        at least the estimated continuation value
+        """
+        values = self.exercise_values(engine, rates)
+        last = len(self._exercise_steps) - 1
+        exercise = values > 0
+        for e in range(last):
+            continuation = np.dot(self.basis(rates[:, e], values[:, e]), self._coefficients[e])
+            exercise[:, e] &= values[:, e] >= continuation
+
+        # the first exercise date of every path, the paths that are never
+        # exercised pay nothing
+        stopped = exercise.any(axis=1)
+        first = np.argmax(exercise, axis=1)
+        paths = np.arange(len(values))
+        return np.where(stopped, discount_factors[paths, first]*values[paths, first], 0.0)
+
+    def fit(self, engine):
+        """
+        Estimates the continuation values with the Longstaff-Schwartz backward
+        regression. The regression of every exercise date is batched over all
+        the chunks of the engine, the chunks only keep the short rates,
+        discount factors and exercise values of the exercise dates
+
+        Parameters
+        ----------
+            engine : a HWMonteCarlo class instance
+
+        """
+        chunks = []
+        for chunk in range(len(engine._chunks)):
+            rates, discount_factors = engine.simulate(chunk)
+            values = self.exercise_values(engine, rates)
+            # cash flow of every path discounted to time 0, starting with the
+            # exercise at the last date
+            cash = discount_factors[:, -1]*values[:, -1]
+            chunks.append((rates, discount_factors, values, cash))
+
+        last = len(self._exercise_steps) - 1
+        self._coefficients = [None]*last
+        for e in reversed(range(last)):
+            # normal equations of the in the money paths of all the chunks
+            size = self._degree + 2
+            normal = np.zeros((size, size))
+            target = np.zeros(size)
+            for rates, discount_factors, values, cash in chunks:
+                itm = values[:, e] > 0
+                basis = self.basis(rates[itm, e], values[itm, e])
+                normal += np.dot(basis.T, basis)
+                target += np.dot(basis.T, cash[itm]/discount_factors[itm, e])
+            self._coefficients[e] = np.linalg.lstsq(normal, target, rcond=None)[0]
+
+            for k, (rates, discount_factors, values, cash) in enumerate(chunks):
+                continuation = np.dot(self.basis(rates[:, e], values[:, e]), self._coefficients[e])
+                exercise = (values[:, e] > 0) & (values[:, e] >= continuation)
+                cash = np.where(exercise, discount_factors[:, e]*values[:, e], cash)
+                chunks[k] = (rates, discount_factors, values, cash)
+
+
+class LSMPricer(object):
+    """
+    Longstaff-Schwartz Monte Carlo pricer of the Bermudan products of the tree
+    (SimpleSwaption and CallableBond), with the same payment and exercise step
+    inputs. The exercise rule is estimated on a set of regression paths and
+    the price is computed on independent paths, chunk by chunk, so the memory
+    is bounded and the chunks can be priced by several processes
+
+    """
+
+    def __init__(self, zcb_prices, zcb_maturities, a, sigma, time_grid, paths=100000,
+                 regression_paths=20000, chunk_size=10000, degree=2, antithetic=True, seed=None):
+        """
+        Initialize a LSMPricer object
+
+        Parameters
+        ----------
+            zcb_prices : array_like of shape (M, ) with the ZCB prices
+            zcb_maturities: array_like of shape (M, ) with the ZCB maturities
+            a : Hull-White parameter (a positive float)
+            sigma : Hull-White parameter (a positive float)
+            time_grid : array_like of shape (N + 1, ) with the time in years of
+                every step of the products, e.g. the times of the HWTree the
+                steps were computed for
+            paths : number of pricing paths, default value is 100000
+            regression_paths : number of regression paths, default value is
+                20000
+            chunk_size : number of paths simulated at once, default value is
+                10000
+            degree : degree of the polynomial in the short rate of the
+                regression, default value is 2
+            antithetic : boolean, if True the paths come in antithetic pairs,
+                default value is True
+            seed : seed of the random streams
+
+        """
+        self._zcb_prices = zcb_prices
+        self._zcb_maturities = zcb_maturities
+        self._a = a
+        self._sigma = sigma
+        self._time_grid = np.asarray(time_grid, dtype=float)
+        self._paths = paths
+        self._regression_paths = regression_paths
+        self._chunk_size = chunk_size
+        self._degree = degree
+        self._antithetic = antithetic
+        # regression and pricing paths use independent streams
+        seed = np.random.SeedSequence(seed)
+        self._seeds = [np.random.SeedSequence(seed.entropy, spawn_key=(j, )) for j in range(2)]
+        self._standard_error = None
+
+    def _engine(self, times, paths, seed):
+        """
+        Helper function that builds the Monte Carlo engine of the exercise
+        times
+        """
+        return HWMonteCarlo(self._zcb_prices, self._zcb_maturities, self._a, self._sigma, times,
+                            paths=paths, chunk_size=self._chunk_size,
+                            antithetic=self._antithetic, seed=seed)
+
+    def get_price(self, instrument, payoff=None, processes=None):
+        """
+        This function computes the price of a Bermudan product
+
+        Parameters
+        ----------
+            instrument: a SimpleSwaption or CallableBond class instance
+            payoff: a PayerSwaption or ReceiverSwaption class instance, only
+                for SimpleSwaption
+            processes : number of processes the pricing chunks are distributed
+                over, by default they are priced in this process
+
+        Return
+        ------
+            out: float scalar with the price, the standard error is given by
+                standard_error
+
+        """
+        bond, exercise_steps, exercise, short = instrument._lsm_schedule(payoff)
+        payment_steps = np.asarray(bond._payment_steps)
+        payment_times = self._time_grid[payment_steps]
+        amounts = np.array([bond.coupon(i) for i in payment_steps.tolist()])
+        amounts[-1] += 1.0
+
+        rule = ExerciseRule(payment_times, amounts, payment_steps, exercise_steps, exercise, self._degree)
+        times = self._time_grid[exercise_steps]
+        rule.fit(self._engine(times, self._regression_paths, self._seeds[0]))
+
+        engine = self._engine(times, self._paths, self._seeds[1])
+        price = engine.get_price(rule, processes)
+        self._standard_error = engine.standard_error()
+        if short:
+            price = np.dot(engine.zcb_price(payment_times), amounts) - price
+        return price
+
+    def standard_error(self):
+        """
+        Returns the standard error of the last price
+        """
+        return self._standard_error
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo simulation of the Hull-White short rate with exact transitions
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+def _b(a, h):
+    """
+    Helper function that returns (1 - exp(-a*h))/a, it is h when a is zero
+    """
+    u = np.asarray(a*h, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where(u > 0, -np.expm1(-u)/u, 1.0)
+    return h*ratio
+
+
+def _integral_variance(a, sigma, h):
+    """
+    Helper function that returns the variance of the integral of x over a
+    period of length h starting at x = 0, (sigma/a)^2*(h - 2*B(h) + B2(h))
+    with B2 the B function of 2a. The terms cancel for small a*h, there the
+    Taylor series of the bracket is used
+    """
+    h = np.asarray(h, dtype=float)
+    u = a*h
+    n = np.arange(3, 12)
+    coefficients = (-1.0)**n*(2 - 2.0**(n - 1))/np.cumprod(np.arange(1, 12))[2:]
+    series = np.dot(u[..., None]**(n - 3), coefficients)*h**3
+    with np.errstate(invalid='ignore', divide='ignore'):
+        exact = (h - 2*_b(a, h) + _b(2*a, h))/a**2
+    return sigma**2*np.where(u < 0.1, series, exact)
+
+
+class HWMonteCarlo(object):
+    """
+    Monte Carlo engine of the Hull-White model. The short rate is r = x + phi
+    with dx = -a*x*dt + sigma*dW and phi fitted to the ZCB curve, and the
+    pair (x, integral of x) is simulated with its exact Gaussian transition
+    between the simulation times, so there is no discretization error. The
+    paths are generated in chunks, each one with its own random stream, and
+    the payoffs are evaluated on the path matrices of every chunk
+
+    """
+
+    def __init__(self, zcb_prices, zcb_maturities, a, sigma, times, paths=100000,
+                 chunk_size=10000, antithetic=True, seed=None):
+        """
+        Initialize a HWMonteCarlo object
+
+        Parameters
+        ----------
+            zcb_prices : array_like of shape (M, ) with the ZCB prices
+            zcb_maturities: array_like of shape (M, ) with the ZCB maturities,
+                the log prices are linearly interpolated as in HWTree
+            a : Hull-White parameter (a positive float)
+            sigma : Hull-White parameter (a positive float)
+            times : array_like of shape (T, ) with the increasing positive
+                simulation times in years
+            paths : number of paths, default value is 100000
+            chunk_size : number of paths simulated at once, default value is
+                10000
+            antithetic : boolean, if True every chunk holds the antithetic
+                path of every path, default value is True
+            seed : integer seed or SeedSequence of the random streams, the
+                chunk j always uses the stream j, so the prices do not depend
+                on how the chunks are distributed over processes
+
+        """
+        self._zcb_prices = np.asarray(zcb_prices, dtype=float)
+        self._zcb_maturities = np.asarray(zcb_maturities, dtype=float)
+        self._a = a
+        self._sigma = sigma
+        self._times = np.asarray(times, dtype=float)
+        self._antithetic = antithetic
+
+        # chunk sizes, even if the paths come in antithetic pairs
+        step = 2 if antithetic else 1
+        chunk_size = max(step, chunk_size - chunk_size % step)
+        paths = paths + (-paths) % step
+        self._chunks = [min(chunk_size, paths - start) for start in range(0, paths, chunk_size)]
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        # the streams are the children of the seed, they are built from its
+        # spawn key rather than spawned so that the same seed always gives the
+        # same streams
+        self._seeds = [np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (j, ),
+                                              pool_size=seed.pool_size)
+                       for j in range(len(self._chunks))]
+        self._paths = paths
+        self._standard_error = None
+
+        self.update_parameters()
+
+    def update_parameters(self):
+        """
+        Helper function that computes the deterministic part of the model on
+        the simulation times: the ZCB prices, the shift phi and the moments of
+        the exact transition of every period
+        """
+        a, sigma, times = self._a, self._sigma, self._times
+        self._zcb_grid = self.zcb_price(times)
+        self._phi = self.forward_rate(times) + 0.5*sigma**2*_b(a, times)**2
+        self._variance = _integral_variance(a, sigma, times)
+
+        # moments of (x, integral of x) over every period
+        h = np.diff(np.append(0, times))
+        self._decay = np.exp(-a*h)
+        self._integral_decay = _b(a, h)
+        x_std = sigma*np.sqrt(_b(2*a, h))
+        integral_std = np.sqrt(_integral_variance(a, sigma, h))
+        correlation = 0.5*sigma**2*_b(a, h)**2/(x_std*integral_std)
+        self._x_std = x_std
+        self._integral_std = integral_std*np.array([correlation, np.sqrt(1 - correlation**2)])
+
+    def zcb_price(self, maturities):
+        """
+        Returns the ZCB prices of the curve at the given maturities
+        """
+        log_prices = np.log(self._zcb_prices)
+        return np.exp(np.interp(maturities, self._zcb_maturities, log_prices))
+
+    def forward_rate(self, times):
+        """
+        Returns the instantaneous forward rates of the curve at the given times,
+        they are constant between the maturities of the curve
+        """
+        log_prices = np.log(self._zcb_prices)
+        slopes = -np.diff(log_prices)/np.diff(self._zcb_maturities)
+        index = np.clip(np.searchsorted(self._zcb_maturities, times, side='right') - 1, 0, len(slopes) - 1)
+        return slopes[index]
+
+    def bond_price(self, k, maturities, rates):
+        """
+        Returns the ZCB prices at the simulation time k on every path
+
+        Parameters
+        ----------
+            k : integer index of the simulation time
+            maturities : array_like of shape (L, ) with the maturities in years
+                of the bonds
+            rates : ndarray of shape (N, ) with the short rates of the paths at
+                the time k
+
+        Return
+        ------
+            out: ndarray of shape (N, L)
+
+        """
+        a, sigma = self._a, self._sigma
+        t = self._times[k]
+        maturities = np.atleast_1d(np.asarray(maturities, dtype=float))
+        x = rates - self._phi[k]
+        log_a = (np.log(self.zcb_price(maturities)/self._zcb_grid[k])
+                 + 0.5*(_integral_variance(a, sigma, maturities - t)
+                        - _integral_variance(a, sigma, maturities) + self._variance[k]))
+        return np.exp(log_a - np.outer(x, _b(a, maturities - t)))
+
+    def simulate(self, chunk):
+        """
+        Simulates the paths of a chunk
+
+        Parameters
+        ----------
+            chunk : integer index of the chunk
+
+        Return
+        ------
+            out: tuple with the short rates and the discount factors from time
+                0 of the paths, ndarrays of shape (N, T)
+
+        """
+        size = self._chunks[chunk]
+        generator = np.random.default_rng(self._seeds[chunk])
+        half = size//2 if self._antithetic else size
+        normals = generator.standard_normal((2, half, len(self._times)))
+        if self._antithetic:
+            normals = np.concatenate((normals, -normals), axis=1)
+
+        x_shocks = normals[0]*self._x_std
+        integral_shocks = normals[0]*self._integral_std[0] + normals[1]*self._integral_std[1]
+
+        x = np.empty((size, len(self._times)))
+        integral = np.empty((size, len(self._times)))
+        x_previous = np.zeros(size)
+        integral_previous = np.zeros(size)
+        for k in range(len(self._times)):
+            integral_previous = integral_previous + x_previous*self._integral_decay[k] + integral_shocks[:, k]
+            x_previous = x_previous*self._decay[k] + x_shocks[:, k]
+            x[:, k] = x_previous
+            integral[:, k] = integral_previous
+
+        # the discount factors are P(0, t)*exp(-I(t) - V(t)/2), their mean is
+        # the ZCB curve
+        rates = x + self._phi
+        discount_factors = self._zcb_grid*np.exp(-integral - 0.5*self._variance)
+        return rates, discount_factors
+
+    def _chunk_sums(self, chunk, payoff):
+        """
+        Helper function that returns the number of samples, the sum and the
+        sum of squares of the discounted payoffs of a chunk. The antithetic
+        pairs are averaged first, so they count as one sample
+        """
+        rates, discount_factors = self.simulate(chunk)
+        values = np.asarray(payoff(self, rates, discount_factors), dtype=float)
+        if self._antithetic:
+            half = len(values)//2
+            values = 0.5*(values[:half] + values[half:])
+        return len(values), values.sum(axis=0), (values**2).sum(axis=0)
+
+    def get_price(self, payoff, processes=None):
+        """
+        This function computes the price of a product
+
+        Parameters
+        ----------
+            payoff: callable with signature f(engine, rates, discount_factors)
+                that returns the discounted payoff of every path, an ndarray
+                of shape (N, ) (or (N, K) for K products). It can use
+                engine.bond_price and the simulation times engine._times
+            processes : number of processes the chunks are distributed over,
+                by default the chunks are simulated in this process. The
+                payoff must be picklable
+
+        Return
+        ------
+            out: float scalar (or ndarray of shape (K, )) with the price, the
+                standard error is given by standard_error
+
+        """
+        chunks = range(len(self._chunks))
+        if processes is None:
+            results = [self._chunk_sums(chunk, payoff) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(processes) as executor:
+                results = list(executor.map(self._chunk_sums, chunks, [payoff]*len(chunks)))
+
+        samples = sum(result[0] for result in results)
+        total = sum(result[1] for result in results)
+        squares = sum(result[2] for result in results)
+        mean = total/samples
+        self._standard_error = np.sqrt(np.maximum(squares/samples - mean**2, 0)/(samples - 1))
+        return mean
+
+    def standard_error(self):
+        """
+        Returns the standard error of the last price
+        """
+        return self._standard_error
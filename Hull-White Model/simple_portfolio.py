@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Book of products priced together with one backward induction
+"""
+
+import numpy as np
+from simple_adjoint import AdjointEngine
+from simple_rollback import RollbackEngine
+
+
+class Portfolio(object):
+    """
+    Representation of a book of products priced on the same Hull-White tree.
+    The value slices of all the products are stacked as columns of one array,
+    so the whole book is rolled back together with one backward induction
+
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty Portfolio object
+        """
+        self._instruments = []
+        self._payoffs = []
+
+    def add(self, instrument, payoff=None):
+        """
+        Adds a product to the portfolio
+
+        Parameters
+        ----------
+            instrument: a ZCBond, Bond, SimpleDerivative, SimpleSwaption or
+                CallableBond class instance
+            payoff: a PayOff class instance, only for SimpleDerivative and
+                SimpleSwaption
+
+        """
+        self._instruments.append(instrument)
+        self._payoffs.append(payoff)
+
+    def get_prices(self, hw_tree):
+        """
+        This function computes the prices of all the products
+
+        Parameters
+        ----------
+            hw_tree: a HWTree class instance
+
+        Return
+        ------
+            out: ndarray of shape (N, ) with the price of every product in the
+                order they were added
+
+        """
+        engine = RollbackEngine(hw_tree)
+        start, num_columns, columns, events = self._layout()
+
+        # the columns of a product are zero until the time slice where its
+        # backward induction starts, there its events set the final payoff
+        engine.require(start)
+        values = np.zeros((len(engine.states(start)), num_columns))
+        values = self._apply_events(start, values, events)
+        for i in reversed(range(start)):
+            values = engine.step_back(i, values)
+            values = self._apply_events(i, values, events)
+
+        return values[0, columns]
+
+    def get_sensitivities(self, hw_tree):
+        """
+        This function computes the prices of all the products and their
+        sensitivities to the ZCB prices, a and sigma with one adjoint sweep
+        (see AdjointEngine)
+
+        Parameters
+        ----------
+            hw_tree: a HWTree class instance
+
+        Return
+        ------
+            out: dictionary with the prices (ndarray of shape (N, )), the
+                derivatives with respect to the ZCB prices (ndarray of shape
+                (N, M)) and the derivatives with respect to a and sigma
+                (ndarrays of shape (N, ))
+
+        """
+        return AdjointEngine(hw_tree).sensitivities(*self._layout())
+
+    def _layout(self):
+        """
+        Helper function that assigns the columns of every product. It returns
+        the time slice where the backward induction starts, the number of
+        columns, the column of the price of every product and the events of
+        every time slice
+        """
+        # every product takes one or more consecutive columns, its price is in
+        # its last column
+        starts = []
+        columns = []
+        events = {}
+        num_columns = 0
+        for instrument, payoff in zip(self._instruments, self._payoffs):
+            start, width, instrument_events = instrument._portfolio_events(payoff)
+            block = slice(num_columns, num_columns + width)
+            for i, event in instrument_events.items():
+                events.setdefault(i, []).append((block, event))
+            starts.append(start)
+            columns.append(num_columns + width - 1)
+            num_columns += width
+
+        return max(starts), num_columns, columns, events
+
+    def _apply_events(self, i, values, events):
+        """
+        Helper function that applies the events of the time slice i to the
+        columns of every product
+        """
+        for block, event in events.get(i, []):
+            values[:, block] = event(i, values[:, block])
+        return values
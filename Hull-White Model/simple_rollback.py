@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Shared backward induction engine that rolls the value slices of all the
+products back through a calibrated Hull-White tree
+"""
+
+import numpy as np
+from simple_hull_white import LatticeView
+from simple_tree_cache import TREE_CACHE
+
+
+class RollbackEngine(object):
+    """
+    Backward induction engine shared by all the products priced on a Hull-White
+    tree. It steps a whole time slice back at once and calls the product hooks
+    (coupons, exercise decisions, payoffs) at the event steps
+
+    """
+
+    def __init__(self, hw_tree):
+        """
+        Initialize a RollbackEngine object
+
+        Parameters
+        ----------
+            hw_tree: a HWTree class instance, it is calibrated (through the
+                tree cache) lazily up to the time slices the products need
+
+        """
+        if not hw_tree._is_built:
+            TREE_CACHE.calibrate(hw_tree, 1)
+        self._hw_tree = hw_tree
+
+    def require(self, steps):
+        """
+        Makes sure the tree is calibrated up to the time slice steps - 1, the
+        deeper time slices are calibrated on demand and shared through the
+        tree cache
+        """
+        hw_tree = self._hw_tree
+        if steps > hw_tree._calibrated_steps:
+            TREE_CACHE.calibrate_to(hw_tree, min(steps, hw_tree._steps))
+
+    def states(self, i):
+        """
+        Returns the states -j, ..., j of the time slice i
+        """
+        half_width = self._hw_tree.half_width(i)
+        return np.arange(-half_width, half_width + 1)
+
+    def discount_factors(self, i):
+        """
+        Returns the one period discount factors of the time slice i
+        """
+        hw_tree = self._hw_tree
+        half_width = hw_tree.half_width(i)
+        return hw_tree._discount_factors[i, hw_tree._offset - half_width:hw_tree._offset + half_width + 1]
+
+    def step_back(self, i, values):
+        """
+        Computes the discounted expected value at the time slice i of the given
+        values on the time slice i + 1
+
+        Parameters
+        ----------
+            i : integer time slice
+            values : ndarray of shape (N, ) or (N, K) with the values of the
+                time slice i + 1, the K columns are rolled back together
+
+        Return
+        ------
+            out: ndarray of shape (M, ) or (M, K) with the values of the time
+                slice i
+
+        """
+        discount_factors = self.discount_factors(i)
+        discount_factors = discount_factors.reshape((-1, ) + (1, )*(np.ndim(values) - 1))
+        return self._hw_tree._backward_induction(i, values)*discount_factors
+
+    def _rollback(self, values, start, end, events, out):
+        """
+        Helper function that carries out the backward induction and optionally
+        stores every time slice in out
+        """
+        self.require(start)
+        if out is not None:
+            out.slice(start)[...] = values
+        for i in reversed(range(end, start)):
+            values = self.step_back(i, values)
+            if events is not None and i in events:
+                values = events[i](i, values)
+            if out is not None:
+                out.slice(i)[...] = values
+        return values
+
+    def rollback(self, values, start, end=0, events=None):
+        """
+        Rolls the values of the time slice start back to the time slice end
+
+        Parameters
+        ----------
+            values : ndarray of shape (N, ) or (N, K) with the values of the
+                time slice start
+            start : integer time slice of the given values
+            end : integer time slice where the backward induction stops,
+                default value is 0
+            events : dictionary that maps time slices to callables with
+                signature f(i, values), the callable is applied once the
+                values have been discounted back to the time slice i and it
+                returns the new node values (coupons, exercise, payoffs)
+
+        Return
+        ------
+            out: ndarray with the values of the time slice end
+
+        """
+        return self._rollback(np.asarray(values, dtype=float), start, end, events, None)
+
+    def rollback_tree(self, values, start, events=None):
+        """
+        Rolls the values of the time slice start back to the time slice 0 and
+        keeps every time slice
+
+        Parameters
+        ----------
+            values : ndarray of shape (N, ) or (N, K) with the values of the
+                time slice start
+            start : integer time slice of the given values
+            events : dictionary of event callables, see rollback
+
+        Return
+        ------
+            out: LatticeView keyed by (i, j) with the values of all the nodes
+
+        """
+        values = np.asarray(values, dtype=float)
+        self.require(start)
+        half_widths = [self._hw_tree.half_width(i) for i in range(start + 1)]
+        offset = max(half_widths)
+        tree = LatticeView(np.zeros((start + 1, 2*offset + 1) + values.shape[1:]),
+                           half_widths, offset)
+        self._rollback(values, start, 0, events, tree)
+        return tree
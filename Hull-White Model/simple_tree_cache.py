@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide LRU cache of calibrated Hull-White trees
+"""
+
+from collections import OrderedDict
+import copy
+import hashlib
+import numpy as np
+from simple_hull_white import HWTree
+
+
+class HWTreeCache(object):
+    """
+    Process-wide cache of calibrated Hull-White trees. The trees are keyed by a
+    hash of the discount curve, a, sigma (and sigma_times), maturity, steps
+    and time grid, and the least recently used trees are evicted once the
+    memory budget is exceeded.
+    A tree calibrated through the cache shares its arrays with the cached
+    tree, so they must be treated as read-only (HWTree.update_curve and
+    HWTree.extend allocate new arrays)
+
+    """
+
+    def __init__(self, max_bytes=512*2**20):
+        """
+        Initialize a HWTreeCache object
+
+        Parameters
+        ----------
+            max_bytes : memory budget in bytes for the cached trees, default
+                value is 512 MB
+
+        """
+        self._max_bytes = max_bytes
+        self._trees = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def key(hw_tree):
+        """
+        Returns the hash that identifies the calibration of a tree
+
+        Parameters
+        ----------
+            hw_tree: a HWTree class instance
+
+        Return
+        ------
+            out: str
+
+        """
+        digest = hashlib.sha1()
+        for values in (hw_tree._zcb_prices, hw_tree._zcb_maturities, hw_tree._time_grid,
+                       hw_tree._sigma, hw_tree._sigma_times):
+            if values is not None:
+                digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+            digest.update(b'|')
+        digest.update(repr((float(hw_tree._a), float(hw_tree._time), int(hw_tree._steps))).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def tree_bytes(hw_tree):
+        """
+        Returns the memory in bytes of the trees of a calibrated HWTree
+        """
+        arrays = (hw_tree._rates, hw_tree._state_prices, hw_tree._discount_factors, hw_tree._alphas)
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def calibrate(self, hw_tree, steps=None):
+        """
+        Calibrates the given tree, reusing the calibration of a cached tree with
+        the same inputs if there is one
+
+        Parameters
+        ----------
+            hw_tree: a HWTree class instance
+            steps : number of time slices that must be calibrated, by default
+                all of them. A cached tree that is calibrated to fewer time
+                slices is extended and cached again
+
+        Return
+        ------
+            out: the calibrated HWTree class instance
+
+        """
+        key = self.key(hw_tree)
+        cached = self._trees.get(key)
+        if cached is not None:
+            self._hits += 1
+            self._trees.move_to_end(key)
+            hw_tree.__dict__.update(cached.__dict__)
+            return self.calibrate_to(hw_tree, steps, key)
+
+        self._misses += 1
+        hw_tree.hw_prob()
+        hw_tree.calibrate(steps)
+        self.add(hw_tree, key)
+        return hw_tree
+
+    def calibrate_to(self, hw_tree, steps=None, key=None):
+        """
+        Extends the calibration of a tree to the given number of time slices
+        (see HWTree.calibrate_to) and updates the cached tree
+        """
+        if steps is None:
+            steps = hw_tree._steps
+        calibrated_steps = hw_tree._calibrated_steps
+        hw_tree.calibrate_to(steps)
+        if hw_tree._calibrated_steps > calibrated_steps:
+            self.add(hw_tree, key)
+        return hw_tree
+
+    def add(self, hw_tree, key=None):
+        """
+        Adds a calibrated tree to the cache and evicts the least recently used
+        trees if the memory budget is exceeded. Trees larger than the whole
+        budget are not cached
+        """
+        if key is None:
+            key = self.key(hw_tree)
+        size = self.tree_bytes(hw_tree)
+        if size > self._max_bytes:
+            return
+        if key in self._trees:
+            self._bytes -= self.tree_bytes(self._trees.pop(key))
+        # the cache keeps its own copy of the attributes, so a tree that is
+        # recalibrated later on (see HWTree.update_curve) does not change it
+        self._trees[key] = copy.copy(hw_tree)
+        self._bytes += size
+        self._evict()
+
+    def get(self, zcb_prices, zcb_maturities, maturity, steps, a, sigma, time_grid=None,
+            sigma_times=None):
+        """
+        Returns a calibrated HWTree for the given inputs, see HWTree for the
+        description of the parameters
+        """
+        hw_tree = HWTree(zcb_prices, zcb_maturities, maturity, steps, a, sigma, time_grid=time_grid,
+                         sigma_times=sigma_times)
+        return self.calibrate(hw_tree)
+
+    def _evict(self):
+        """
+        Helper function that evicts the least recently used trees until the
+        cached trees fit in the memory budget
+        """
+        while self._bytes > self._max_bytes and self._trees:
+            _, hw_tree = self._trees.popitem(last=False)
+            self._bytes -= self.tree_bytes(hw_tree)
+            self._evictions += 1
+
+    def set_memory_budget(self, max_bytes):
+        """
+        Sets the memory budget in bytes and evicts trees if needed
+        """
+        self._max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        """
+        Removes all the cached trees and resets the counters
+        """
+        self._trees.clear()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def stats(self):
+        """
+        Returns a dictionary with the cache hits, misses, evictions, number of
+        cached trees and memory used in bytes
+        """
+        return {'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions,
+                'trees': len(self._trees), 'bytes': self._bytes}
+
+
+# cache shared by all the products of the process
+TREE_CACHE = HWTreeCache()
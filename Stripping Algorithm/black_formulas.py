@@ -6,7 +6,66 @@ Created on Sat Nov 11 22:59:27 2017
 """
 
 import numpy as np
-from scipy.stats import norm
+from scipy.special import ndtr
+
+SQRT_2PI = np.sqrt(2*np.pi)
+
+
+def black_kernel(discounts, forwards, strikes, vols, resets, maturities,
+                 notional=1000000, call=True, vega=False):
+    """
+    Computes caplet (or floorlet) prices using Black's formula on whole arrays,
+    all the inputs are broadcast together, e.g. forwards of shape (M, ),
+    strikes of shape (K, 1) and vols of shape (V, 1, 1) give prices of shape
+    (V, K, M). The normal CDF is scipy.special.ndtr
+    
+    Parameters
+    ----------
+        discounts: array_like, ZCB prices that mature at payment dates
+        forwards: array_like, forward rates
+        strikes: array_like
+        vols: array_like, caplet volatilities
+        resets: array_like, reset dates in years
+        maturities: array_like, maturity dates in years
+        notional: scalar, default value is 1,000,000.00
+        call: boolean or array_like, caplets if True and floorlets if False,
+            default value is True
+        vega: boolean, if True the vegas are returned too, default value is
+            False
+        
+    Return
+    ------
+        out: ndarray with the prices, or a tuple with the prices and the
+            vegas (derivatives with respect to the volatilities)
+    
+    """
+    discounts = np.asarray(discounts, dtype=float)
+    forwards = np.asarray(forwards, dtype=float)
+    strikes = np.asarray(strikes, dtype=float)
+    vols = np.asarray(vols, dtype=float)
+    resets = np.asarray(resets, dtype=float)
+    tau = np.asarray(maturities, dtype=float) - resets
+    d1 = (np.log(forwards/strikes) + 0.5*vols**2*resets)/(vols*np.sqrt(resets))
+    d2 = d1 - vols*np.sqrt(resets)
+    
+    # the floorlets are the caplets with the signs of the arguments flipped,
+    # the caplets are the same operations as the scalar formula
+    sign = np.where(call, 1.0, -1.0)
+    prices = sign*(forwards*ndtr(sign*d1) - strikes*ndtr(sign*d2))*discounts*tau*notional
+    if not vega:
+        return prices[()]
+    vegas = forwards*np.exp(-0.5*d1**2)/SQRT_2PI*np.sqrt(resets)*discounts*tau*notional
+    return prices[()], vegas[()]
+
+
+def sum_caplets(caplets):
+    """
+    Helper function
+    Sums the caplets along the last axis one after the other, so a cap price
+    does not depend on how many caplets are stacked with it
+    """
+    return np.cumsum(caplets, axis=-1)[..., -1]
+
 
 def black_caplet(discount, forward, strike, caplet_vol, reset, maturity, 
                  notional = 1000000):
@@ -28,37 +87,222 @@ def black_caplet(discount, forward, strike, caplet_vol, reset, maturity,
         out: scalar, caplet price
     
     """
-    tau = maturity - reset
-    d1 = (np.log(forward/strike) + 0.5*caplet_vol**2*reset)/(caplet_vol*np.sqrt(reset))
-    d2 = d1 - caplet_vol*np.sqrt(reset)
-    return (forward*norm.cdf(d1) - strike*norm.cdf(d2))*discount*tau*notional
+    return black_kernel(discount, forward, strike, caplet_vol, reset, maturity, notional)
+
+
+def black_floorlet(discount, forward, strike, floorlet_vol, reset, maturity,
+                   notional=1000000):
+    """
+    Computes floorlet price using Black's formula, see black_caplet
+    """
+    return black_kernel(discount, forward, strike, floorlet_vol, reset, maturity, notional,
+                        call=False)
+
+
+def black_caplet_vega(discount, forward, strike, caplet_vol, reset, maturity,
+                      notional=1000000):
+    """
+    Computes the derivative of the caplet (or floorlet) price with respect to
+    the caplet volatility, see black_caplet
+    """
+    return black_kernel(discount, forward, strike, caplet_vol, reset, maturity, notional,
+                        vega=True)[1]
 
 
 def black_cap_price(discounts, forwards, strike, cap_vol, resets, maturities, 
                     notional=1000000):
     """
-    Computes caplet price using Black's formula
+    Computes cap price using Black's formula
     
     Parameters
     ----------
         discounts: array_like of shape(M, ), ZCB prices that matures at payment 
             dates. M corresponds to the number of caplets that comprise the cap
         forwards: array_like of shape(M, ), forward rates
-        strike: scalar, if it is at-the-money then it is the swap rate
-        caplet_vol: scalar, cap flat volatility
+        strike: scalar, if it is at-the-money then it is the swap rate. An
+            array_like of shape (K, 1) gives K caps
+        cap_vol: scalar, cap flat volatility, or array_like that broadcasts
+            with strike
         resets: array_like of shape(M, ), reset dates in years
         maturities: array_like of shape(M, ), maturity dates in years
         notional: scalar, default value is 1,000,000.00
         
     Return
     ------
-        out: scalar, caplet price
+        out: scalar, cap price (ndarray for several caps)
+    
+    """
+    return sum_caplets(black_kernel(discounts, forwards, strike, cap_vol, resets, maturities,
+                                     notional))
+
+
+def black_floor_price(discounts, forwards, strike, floor_vol, resets, maturities,
+                      notional=1000000):
+    """
+    Computes floor price using Black's formula, see black_cap_price
+    """
+    return sum_caplets(black_kernel(discounts, forwards, strike, floor_vol, resets, maturities,
+                                     notional, call=False))
+
+
+def black_cap_vega(discounts, forwards, strike, cap_vol, resets, maturities,
+                   notional=1000000):
+    """
+    Computes the derivative of the cap (or floor) price with respect to the
+    flat volatility, see black_cap_price
+    """
+    return sum_caplets(black_kernel(discounts, forwards, strike, cap_vol, resets, maturities,
+                                     notional, vega=True)[1])
+
+
+def _implied_vol(prices, lower, upper, guess, pricer, tol, max_iter, max_vol):
+    """
+    Helper function
+    Solves pricer(vols) = prices element by element with Newton steps on the
+    log of the prices, which behave well far out of the money, inside a
+    bracket of volatilities that shrinks with every iteration, a step that
+    leaves its bracket is replaced by a bisection step. The points whose
+    price is not strictly between lower and upper, or above the price of
+    max_vol, are not solved
+    
+    Return
+    ------
+        out: tuple with the volatilities (nan where not solved) and the
+            boolean mask of the solved points
+    
+    """
+    valid = np.isfinite(prices) & (prices > lower) & (prices < upper)
+    with np.errstate(all='ignore'):
+        valid &= pricer(np.full(prices.shape, max_vol))[0] >= prices
+        lo = np.zeros(prices.shape)
+        hi = np.full(prices.shape, float(max_vol))
+        vols = np.where((guess > 0) & (guess < max_vol), guess, 0.5*max_vol)
+        done = ~valid
+        for _ in range(max_iter):
+            if done.all():
+                break
+            model, vegas = pricer(vols)
+            error = np.log(model/prices)
+            lo = np.where(error < 0, vols, lo)
+            hi = np.where(error > 0, vols, hi)
+            new_vols = vols - error*model/vegas
+            new_vols = np.where((lo < new_vols) & (new_vols < hi), new_vols, 0.5*(lo + hi))
+            converged = (np.abs(new_vols - vols) < tol) | (error == 0)
+            vols = np.where(done, vols, np.where(error == 0, vols, new_vols))
+            done |= converged
+    solved = valid & done
+    return np.where(solved, vols, np.nan)[()], solved[()]
+
+
+def black_implied_vol(prices, discounts, forwards, strikes, resets, maturities,
+                      notional=1000000, call=True, tol=1.e-10, max_iter=50, max_vol=5.0):
+    """
+    Computes the Black volatilities implied by caplet (or floorlet) prices,
+    all the inputs are broadcast together and all the prices are inverted at
+    once. The initial guesses are the rational approximation of Corrado and
+    Miller, which are refined with Newton steps with the analytic vega
+    
+    Parameters
+    ----------
+        prices: array_like, caplet (or floorlet) prices
+        discounts: array_like, ZCB prices that mature at payment dates
+        forwards: array_like, forward rates
+        strikes: array_like
+        resets: array_like, reset dates in years
+        maturities: array_like, maturity dates in years
+        notional: scalar, default value is 1,000,000.00
+        call: boolean or array_like, caplets if True and floorlets if False,
+            default value is True
+        tol: scalar, tolerance of the volatilities, default value is 1e-10
+        max_iter: int, maximum number of iterations, default value is 50
+        max_vol: scalar, largest volatility, default value is 5
+        
+    Return
+    ------
+        out: tuple with the implied volatilities (nan where they were not
+            found) and the boolean mask of the prices that were inverted, the
+            prices outside the no-arbitrage bounds, with a reset date that is
+            not positive or that did not converge are False
     
     """
-    num_caplets = len(forwards)
-    caplets = np.zeros(num_caplets)
-    for i in range(num_caplets):
-        caplets[i] = black_caplet(discounts[i], forwards[i], strike, cap_vol, 
-               resets[i], maturities[i], notional)
+    prices, discounts, forwards, strikes, resets, maturities, call = np.broadcast_arrays(
+        *(np.asarray(v, dtype=float) for v in (prices, discounts, forwards, strikes, resets,
+                                               maturities, call)))
+    call = call.astype(bool)
+    annuity = discounts*(maturities - resets)*notional
+    
+    # the bounds of a caplet (floorlet) are the intrinsic value and the
+    # forward (strike)
+    spread = forwards - strikes
+    lower = np.maximum(np.where(call, spread, -spread), 0)*annuity
+    upper = np.where(resets > 0, np.where(call, forwards, strikes)*annuity, -np.inf)
+    
+    # Corrado-Miller guess of the total volatility, written for caplets so
+    # the floorlets are turned into caplets with the put-call parity
+    with np.errstate(all='ignore'):
+        excess = np.where(call, prices, prices + spread*annuity)/annuity - 0.5*spread
+        root = np.sqrt(np.maximum(excess**2 - spread**2/np.pi, 0))
+        guess = np.sqrt(2*np.pi)/(forwards + strikes)*(excess + root)/np.sqrt(resets)
+    
+    def pricer(vols):
+        return black_kernel(discounts, forwards, strikes, vols, resets, maturities, notional,
+                            call, vega=True)
+    
+    return _implied_vol(prices, lower, upper, guess, pricer, tol, max_iter, max_vol)
+
+
+def black_cap_implied_vol(prices, discounts, forwards, strike, resets, maturities,
+                          notional=1000000, call=True, tol=1.e-10, max_iter=50, max_vol=5.0):
+    """
+    Computes the flat Black volatilities implied by cap (or floor) prices, the
+    caplets of every cap lie along the last axis of the caplet inputs and all
+    the caps are inverted at once
+    
+    Parameters
+    ----------
+        prices: array_like of shape(...), cap (or floor) prices
+        discounts: array_like of shape(..., M), ZCB prices that mature at
+            payment dates
+        forwards: array_like of shape(..., M), forward rates
+        strike: array_like of shape(...), cap strikes
+        resets: array_like of shape(..., M), reset dates in years
+        maturities: array_like of shape(..., M), maturity dates in years
+        notional: scalar, default value is 1,000,000.00
+        call: boolean or array_like of shape(...), caps if True and floors if
+            False, default value is True
+        tol: scalar, tolerance of the volatilities, default value is 1e-10
+        max_iter: int, maximum number of iterations, default value is 50
+        max_vol: scalar, largest volatility, default value is 5
         
-    return sum(caplets)
\ No newline at end of file
+    Return
+    ------
+        out: tuple with the implied flat volatilities (nan where they were not
+            found) and the boolean mask of the prices that were inverted, see
+            black_implied_vol
+    
+    """
+    prices = np.asarray(prices, dtype=float)[..., None]
+    strike = np.asarray(strike, dtype=float)[..., None]
+    call = np.asarray(call, dtype=bool)[..., None]
+    prices, discounts, forwards, strike, resets, maturities, call = np.broadcast_arrays(
+        prices, np.asarray(discounts, dtype=float), np.asarray(forwards, dtype=float), strike,
+        np.asarray(resets, dtype=float), np.asarray(maturities, dtype=float), call)
+    prices = prices[..., 0]
+    annuity = discounts*(maturities - resets)*notional
+    
+    # the bounds of a cap are the sums of the bounds of its caplets
+    spread = np.where(call, forwards - strike, strike - forwards)
+    lower = sum_caplets(np.maximum(spread, 0)*annuity)
+    upper = sum_caplets(np.where(call, forwards, strike)*annuity)
+    upper = np.where(np.all(resets > 0, axis=-1), upper, -np.inf)
+    
+    # at-the-money guess from the time value and the vega of the caplets
+    with np.errstate(all='ignore'):
+        guess = np.sqrt(2*np.pi)*(prices - lower)/sum_caplets(0.5*(forwards + strike)*annuity*np.sqrt(resets))
+    
+    def pricer(vols):
+        caplets, vegas = black_kernel(discounts, forwards, strike, vols[..., None], resets,
+                                      maturities, notional, call, vega=True)
+        return sum_caplets(caplets), sum_caplets(vegas)
+    
+    return _implied_vol(prices, lower, upper, guess, pricer, tol, max_iter, max_vol)
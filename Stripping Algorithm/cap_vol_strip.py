@@ -5,14 +5,110 @@ Created on Sat Nov 11 22:57:39 2017
 @author: Jesus
 """
 
-from black_formulas import black_cap_price, black_caplet
+from black_formulas import sum_caplets, black_kernel
 import pandas as pd
 import numpy as np
 from scipy.interpolate import interp1d
-from scipy.optimize import bisect
 
 NUM_DAYS = 360
 
+
+def safeguarded_newton(func, a, b, x0, xtol=2.e-12, rtol=8.88e-16, maxiter=100):
+    """
+    Finds the roots of a function in the brackets [a, b] with Newton's method,
+    the brackets shrink with every iteration and a Newton step that leaves its
+    bracket is replaced by a bisection step. The function is evaluated on all
+    the roots at once, element by element
+    
+    Parameters
+    ----------
+        func: callable, returns the values and the derivatives of the function
+        a: scalar or array_like, lower ends of the brackets
+        b: scalar or array_like, upper ends of the brackets
+        x0: scalar or array_like, initial guesses
+        xtol: scalar, absolute tolerance of the roots
+        rtol: scalar, relative tolerance of the roots
+        maxiter: int, maximum number of iterations
+
+    Return
+    ------
+        out: scalar or ndarray, roots
+    
+    """
+    a, b, x0 = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (a, b, x0)))
+    a, b = a.copy(), b.copy()
+    f_a = np.asarray(func(a)[0])
+    f_b = np.asarray(func(b)[0])
+    if np.any((np.sign(f_a) == np.sign(f_b)) & (f_a != 0)):
+        raise ValueError('f(a) and f(b) must have different signs')
+    
+    # the roots at the ends of the brackets are found already
+    roots = np.where(f_a == 0, a, np.where(f_b == 0, b, np.nan))
+    done = ~np.isnan(roots)
+    x = np.where((a < x0) & (x0 < b), x0, 0.5*(a + b))
+    for _ in range(maxiter):
+        if done.all():
+            return roots[()]
+        f, df = func(x)
+        same = np.sign(f) == np.sign(f_a)
+        a = np.where(same, x, a)
+        b = np.where(same, b, x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_x = x - f/df
+        new_x = np.where((a < new_x) & (new_x < b), new_x, 0.5*(a + b))
+        converged = np.abs(new_x - x) < xtol + rtol*np.abs(new_x)
+        roots = np.where(done, roots, np.where(f == 0, x, new_x))
+        done |= converged | (f == 0)
+        x = new_x
+    if done.all():
+        return roots[()]
+    raise RuntimeError('the root search did not converge after %d iterations' % maxiter)
+
+
+def strip_caplets(discounts, forwards, strikes, cap_prices, cap_vols, resets, maturities,
+                  notional=1000000.0):
+    """
+    Strips caplet volatilities from cap prices, one row of caps at a time:
+    the cap i of a row is made of the caplets 0, ..., i at the strike of the
+    cap. The caplets before i have their volatilities already, so they are
+    priced once at the strikes of the caps i, and the caplet i of all the
+    rows is found with one batched safeguarded Newton search
+    
+    Parameters
+    ----------
+        discounts: array_like of shape(M, ), ZCB prices
+        forwards: array_like of shape(M, ), forward rates
+        strikes: array_like of shape(K, M), strikes of the caps
+        cap_prices: array_like of shape(K, M), cap prices
+        cap_vols: array_like of shape(K, M), interpolated cap volatilities,
+            the first caplet of every row has the first cap volatility
+        resets: array_like of shape(M, ), reset dates in years
+        maturities: array_like of shape(M, ), maturity dates in years
+        notional: scalar, default value is 1,000,000.00
+
+    Return
+    ------
+        out: ndarray of shape(K, M), caplet volatilities
+    
+    """
+    caplet_vols = np.array(cap_vols, dtype=float)
+    strikes = np.broadcast_to(np.asarray(strikes, dtype=float), caplet_vols.shape)
+    for i in range(1, caplet_vols.shape[1]):
+        known = black_kernel(discounts[:i], forwards[:i], strikes[:, i, None], caplet_vols[:, :i],
+                             resets[:i], maturities[:i], notional)
+        targets = cap_prices[:, i] - sum_caplets(known)
+        
+        def func(new_vols):
+            prices, vegas = black_kernel(discounts[i], forwards[i], strikes[:, i], new_vols,
+                                         resets[i], maturities[i], notional, vega=True)
+            return prices - targets, vegas
+        
+        # Newton's method with the analytic vega, safeguarded by bisection
+        # steps, starting from the previous caplet volatility
+        caplet_vols[:, i] = safeguarded_newton(func, 1.e-8, 2.0, caplet_vols[:, i - 1])
+    return caplet_vols
+
+
 class CapVolStrip(object):
     """
     This class hold annual and quarterly data for caps and caplets, respectively.
@@ -24,8 +120,9 @@ class CapVolStrip(object):
     dule black_formulas.
     """
     def __init__(self, cap_data, data):
-        # cap data, annual data
-        self._cap_vols = cap_data['Cap Vol']
+        # cap data, annual data, the numeric inputs are converted to contiguous
+        # arrays once
+        self._cap_vols = np.ascontiguousarray(cap_data['Cap Vol'], dtype=float)
         self._cap_maturity_dates = cap_data['Maturity Date']
         self._cap_maturities =  None
         
@@ -33,9 +130,9 @@ class CapVolStrip(object):
         # caples)
         self._maturity_dates = data['Maturity Date']
         self._reset_dates = data['Reset Date']
-        self._discounts = data['ZCB']
-        self._forwards = data['Forward']
-        self._strikes = data['Strike']
+        self._discounts = np.ascontiguousarray(data['ZCB'], dtype=float)
+        self._forwards = np.ascontiguousarray(data['Forward'], dtype=float)
+        self._strikes = np.ascontiguousarray(data['Strike'], dtype=float)
         self._interpolated_cap_vols = None
         self._maturities =  None
         self._resets =  None
@@ -131,10 +228,13 @@ class CapVolStrip(object):
     def compute_cap_prices(self, notional=1000000):
         """
         Helper function
+        Computes the cap prices with the interpolated flat volatilities, the
+        cap i is made of the caplets 0, ..., i at the strike and the flat
+        volatility of the cap i
         
         Parameters
         ----------
-            data:  array_like of shape(M, )
+            notional: scalar, default value is 1,000,000.00
 
         Return
         ------
@@ -142,24 +242,16 @@ class CapVolStrip(object):
         
         """
         n = self._num_obs
-        cap_prices = np.zeros(n)
-        
-        # compute all the cap prices one by one
-        for i in range(n):
-            # set all the arguments that Black's formula requires to compute cap
-            # price
-            discounts = self._discounts[:i + 1]        
-            forwards = self._forwards[:i + 1]
-            strike = self._strikes[i]        
-            cap_vol = self._interpolated_cap_vols[i]
-            resets = self._resets[:i + 1]
-            maturities = self._maturities[:i + 1]
-            
-            # compute the cap price
-            cap_prices[i] = black_cap_price(discounts, forwards, strike, cap_vol, resets, maturities, notional)
         
-        self._cap_prices = cap_prices
-        return cap_prices
+        # all the caplets of all the caps as one (caps x caplets) matrix, the
+        # caps only hold the caplets on and below the diagonal
+        caplets = black_kernel(self._discounts, self._forwards, self._strikes[:, None],
+                               self._interpolated_cap_vols[:, None], self._resets,
+                               self._maturities, notional)
+        caplets = np.where(np.tri(n, dtype=bool), caplets, 0.0)
+        
+        self._cap_prices = sum_caplets(caplets)
+        return self._cap_prices
     
     def strip_cap_vol(self):
         """
@@ -174,33 +266,9 @@ class CapVolStrip(object):
                 caplet volatilities
         
         """
-        num_stripped_vol = self._num_obs
-        self._caplet_vols = self._interpolated_cap_vols.copy()
-        # stripping algorith
-        for i in range(1, num_stripped_vol):
-            # bisection method procedure 
-            # define a function that depends on new volatility that bisection will find
-            def func(new_vol):
-                result = self._cap_prices[i]
-                for j in range(i + 1):
-                    discount = self._discounts[j]
-                    forward = self._forwards[j]
-                    strike = self._strikes[i]
-                    caplet_vol = self._caplet_vols[j]
-                    reset = self._resets[j]                
-                    maturity = self._maturities[j]
-                    notional = 1000000.0
-                    
-                    if j < i:
-                        result -= black_caplet(discount, forward, strike, caplet_vol, reset, maturity, notional)
-                    else:
-                        result -= black_caplet(discount, forward, strike, new_vol, reset, maturity, notional)
-                        
-                return result
-            
-            # use bisection method to compute the caplet volatility that match the cap price.
-            a = 1.e-8
-            b = 2.0
-            self._caplet_vols[i] = bisect(func, a, b)
+        notional = 1000000.0
+        # stripping algorith, the caps are stripped as a single row
+        self._caplet_vols = strip_caplets(self._discounts, self._forwards, self._strikes[None],
+                                          self._cap_prices[None], self._interpolated_cap_vols[None],
+                                          self._resets, self._maturities, notional)[0]
         return self._caplet_vols
-    
\ No newline at end of file
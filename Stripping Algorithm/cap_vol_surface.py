@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Caplet volatility surface stripped from a matrix of cap volatilities
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from black_formulas import sum_caplets, black_kernel
+from cap_vol_strip import CapVolStrip, strip_caplets
+import pandas as pd
+import numpy as np
+from scipy.interpolate import interp1d, RegularGridInterpolator
+
+
+class CapletVolSurface(object):
+    """
+    This class holds the caplet volatilities of several strikes, one row per
+    caplet and one column per strike. Volatilities between the caplet matu-
+    rities and the strikes are interpolated linearly in both dimensions, and
+    outside the grid they are extended flat.
+    """
+    def __init__(self, resets, maturities, strikes, vols):
+        self._resets = np.asarray(resets, dtype=float)
+        self._maturities = np.asarray(maturities, dtype=float)
+        self._strikes = np.asarray(strikes, dtype=float)
+        self._vols = np.asarray(vols, dtype=float)
+        self._interpolator = RegularGridInterpolator((self._maturities, self._strikes), self._vols)
+
+    @property
+    def strikes(self):
+        return self._strikes
+
+    @property
+    def maturities(self):
+        return self._maturities
+
+    @property
+    def vols(self):
+        return self._vols
+
+    def vol(self, maturity, strike):
+        """
+        Interpolates the caplet volatility
+
+        Parameters
+        ----------
+            maturity: scalar or array_like, caplet maturities in years
+            strike: scalar or array_like, strikes (broadcast with maturity)
+
+        Return
+        ------
+            out: scalar or ndarray, caplet volatilities
+
+        """
+        maturity, strike = np.broadcast_arrays(np.asarray(maturity, dtype=float),
+                                               np.asarray(strike, dtype=float))
+        points = np.stack((np.clip(maturity, self._maturities[0], self._maturities[-1]),
+                           np.clip(strike, self._strikes[0], self._strikes[-1])), axis=-1)
+        return self._interpolator(points).reshape(maturity.shape)[()]
+
+    def to_frame(self):
+        """
+        Returns the caplet volatilities as a DataFrame, indexed by the caplet
+        maturities with one column per strike
+        """
+        return pd.DataFrame(self._vols, index=self._maturities, columns=self._strikes)
+
+
+class CapVolSurfaceStrip(CapVolStrip):
+    """
+    This class strips caplet volatilities from a matrix of flat cap volatili-
+    ties, one column per strike. All the strikes are stripped together: the
+    cap prices of all the strikes are computed at once and the caplet i of
+    all the strikes is found with one batched root search, optionally with
+    the strikes split over several processes. Every strike gives the same
+    volatilities as CapVolStrip with that fixed strike up to the last cap,
+    after it the surface repeats the last cap volatility while CapVolStrip
+    repeats the first one.
+    """
+    def __init__(self, cap_data, data, strikes):
+        """
+        Parameters
+        ----------
+            cap_data: DataFrame, annual data with a 'Maturity Date' column and
+                one column of cap volatilities per strike, named by the strike
+            data: DataFrame, quarterly data with the 'Maturity Date', 'Reset
+                Date', 'ZCB' and 'Forward' columns
+            strikes: array_like of shape(K, ), strikes of the columns of cap
+                volatilities
+
+        """
+        order = np.argsort(np.asarray(strikes, dtype=float))
+        strikes = [strikes[k] for k in order]
+
+        # cap data, annual data, one row per cap and one column per strike
+        self._cap_vols = np.ascontiguousarray(cap_data[strikes], dtype=float)
+        self._cap_maturity_dates = cap_data['Maturity Date']
+        self._cap_maturities = None
+        self._strike_grid = np.asarray(strikes, dtype=float)
+
+        # caplet data, quarterly
+        self._maturity_dates = data['Maturity Date']
+        self._reset_dates = data['Reset Date']
+        self._discounts = np.ascontiguousarray(data['ZCB'], dtype=float)
+        self._forwards = np.ascontiguousarray(data['Forward'], dtype=float)
+        self._strikes = None
+        self._interpolated_cap_vols = None
+        self._maturities = None
+        self._resets = None
+        self._cap_prices = None
+        self._caplet_vols = None
+        self._surface = None
+
+        self._num_obs = len(data)
+
+    def interpolate_cap_vol(self, kind='linear', extrapolate=False):
+        """
+        Interpolate cap flat volatilities of all the strikes
+
+        Parameters
+        ----------
+            kind: str or int, optional
+                specifies the kind of interpolation, see CapVolStrip
+            extrapolate: boolean
+                if False, it will repeat the first (last) cap volatility for
+                periods before the first (after the last) cap
+
+        Return
+        ------
+            out: array_like of shape(K, M)
+                interpolated cap volatilities, one row per strike
+
+        """
+        if extrapolate:
+            fill_value = 'extrapolate'
+        else:
+            fill_value = (self._cap_vols[0], self._cap_vols[-1])
+
+        f = interp1d(self._cap_maturities, self._cap_vols, kind=kind, axis=0,
+                     bounds_error=False, fill_value=fill_value)
+        self._interpolated_cap_vols = np.ascontiguousarray(f(self._maturities).T)
+
+        return self._interpolated_cap_vols
+
+    def compute_cap_prices(self, notional=1000000):
+        """
+        Computes the cap prices of all the strikes, the cap i of a strike is
+        made of the caplets 0, ..., i at the interpolated flat volatility of
+        the cap i
+
+        Parameters
+        ----------
+            notional: scalar, default value is 1,000,000.00
+
+        Return
+        ------
+            out: array_like of shape(K, M)
+
+        """
+        n = self._num_obs
+
+        # one (caps x caplets) lower-triangular matrix per strike
+        caplets = black_kernel(self._discounts, self._forwards, self._strike_grid[:, None, None],
+                               self._interpolated_cap_vols[:, :, None], self._resets,
+                               self._maturities, notional)
+        caplets = np.where(np.tri(n, dtype=bool), caplets, 0.0)
+
+        self._cap_prices = sum_caplets(caplets)
+        return self._cap_prices
+
+    def strip_cap_vol(self, notional=1000000, processes=None):
+        """
+        Compute caplet volatilities of all the strikes
+
+        Parameters
+        ----------
+            notional: scalar, notional of the cap prices, default value is
+                1,000,000.00
+            processes: int, number of processes the strikes are split over,
+                by default all the strikes are stripped in this process
+
+        Return
+        ------
+            out: CapletVolSurface
+
+        """
+        strikes = np.arange(len(self._strike_grid))
+        if processes is None:
+            chunks = [strikes]
+        else:
+            chunks = [chunk for chunk in np.array_split(strikes, processes) if len(chunk) > 0]
+        args = [(self._discounts, self._forwards, self._strike_grid[chunk, None], self._cap_prices[chunk],
+                 self._interpolated_cap_vols[chunk], self._resets, self._maturities, notional)
+                for chunk in chunks]
+
+        if processes is None:
+            results = [strip_caplets(*args[0])]
+        else:
+            with ProcessPoolExecutor(processes) as executor:
+                results = list(executor.map(strip_caplets, *zip(*args)))
+        self._caplet_vols = np.vstack(results).T
+
+        self._surface = CapletVolSurface(self._resets, self._maturities, self._strike_grid,
+                                         self._caplet_vols)
+        return self._surface
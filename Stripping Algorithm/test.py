@@ -6,9 +6,12 @@ Created on Sat Nov 11 23:50:05 2017
 """
 
 
+import numpy as np
 import pandas as pd
 import datetime
 from cap_vol_strip import CapVolStrip
+from cap_vol_surface import CapVolSurfaceStrip
+from black_formulas import black_caplet, black_implied_vol
 
 # read data from spreadsheets (annual and quarterly (keep in mind the column 
 # names and formats presented in this test are required to avoid any crash)
@@ -43,3 +46,44 @@ print(vol_stripper._cap_prices)
 vol_stripper.strip_cap_vol()
 print(vol_stripper._caplet_vols)
 
+
+# invert the caplet prices of the stripped volatilities back to volatilities
+caplet_prices = black_caplet(vol_stripper._discounts, vol_stripper._forwards,
+                             vol_stripper._strikes, vol_stripper._caplet_vols,
+                             vol_stripper._resets, vol_stripper._maturities)
+implied_vols, inverted = black_implied_vol(caplet_prices, vol_stripper._discounts,
+                                           vol_stripper._forwards, vol_stripper._strikes,
+                                           vol_stripper._resets, vol_stripper._maturities)
+print(implied_vols)
+print('All caplet prices inverted: {}'.format(inverted.all()))
+print('Largest implied volatility error: {:1.2e}'.format(
+        np.max(np.abs(implied_vols - vol_stripper._caplet_vols))))
+
+# strip a matrix of cap volatilities, one column per strike (here the sample
+# volatilities with a linear skew), and check every column against
+# CapVolStrip with that fixed strike
+strikes = [0.010, 0.012, 0.015]
+cap_matrix = pd.DataFrame({'Maturity Date': cap_data['Maturity Date']})
+for strike in strikes:
+    cap_matrix[strike] = cap_data['Cap Vol']*(1 + 10*(0.012 - strike))
+
+surface_stripper = CapVolSurfaceStrip(cap_matrix, forward_data, strikes)
+surface_stripper.add_dates2years(today)
+surface_stripper.interpolate_cap_vol()
+surface_stripper.compute_cap_prices()
+surface = surface_stripper.strip_cap_vol()
+print(surface.to_frame())
+print('Caplet volatility at 2.5 years and 1.3%: {:1.6f}'.format(surface.vol(2.5, 0.013)))
+
+for k, strike in enumerate(strikes):
+    strike_data = forward_data.copy()
+    strike_data['Strike'] = strike
+    strike_caps = pd.DataFrame({'Maturity Date': cap_matrix['Maturity Date'],
+                                'Cap Vol': cap_matrix[strike]})
+    strike_stripper = CapVolStrip(strike_caps, strike_data)
+    strike_stripper.add_dates2years(today)
+    strike_stripper.interpolate_cap_vol()
+    strike_stripper.compute_cap_prices()
+    strike_stripper.strip_cap_vol()
+    print('Strike {:1.3f} same as CapVolStrip: {}'.format(
+            strike, np.array_equal(strike_stripper._caplet_vols, surface.vols[:, k])))